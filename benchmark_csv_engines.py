@@ -0,0 +1,95 @@
+import argparse
+import asyncio
+import importlib
+import logging
+import time
+from typing import Iterable
+
+import pandas as pd
+
+from opendata.sources.bikeshare import open_and_concat_paths
+from opendata.sources.bikeshare import SUPPORTED_MARKETS
+from opendata.sources.bikeshare.csv_readers import CsvEngine
+from opendata.sources.bikeshare.load_options import LoadOptions
+from opendata.sources.bikeshare.periods import DateRange
+from opendata.sources.bikeshare.sampling import SampleConfig
+
+
+def benchmark_csv_engines(
+    markets: Iterable[str], sample_rate: int, date_range: DateRange
+) -> pd.DataFrame:
+    """Time parsing each market's cached archives with every CSV engine
+
+    Archives are downloaded first if needed, and the parsed cache is bypassed so
+    only CSV parsing and column mapping are timed.
+    """
+    rows = []
+    for market in markets:
+        trips = importlib.import_module(f"opendata.sources.bikeshare.{market}").trips
+        cached_files = asyncio.run(
+            trips.async_download(LoadOptions(date_range=date_range))
+        )
+        for engine in CsvEngine:
+            started_at = time.monotonic()
+            trips_df, _ = open_and_concat_paths(
+                cached_files,
+                trip_sample=SampleConfig(rate=sample_rate),
+                trip_parsers=trips.trips_parsers,
+                ignore_cols=trips.ignore_cols,
+                station_parsers=trips.stations_parsers,
+                date_range=date_range,
+                engine=engine,
+            )
+            rows.append(
+                {
+                    "market": market,
+                    "engine": engine.value,
+                    "trips": len(trips_df),
+                    "sec": time.monotonic() - started_at,
+                }
+            )
+
+    results = pd.DataFrame(rows)
+    baseline = results["market"].map(
+        results[results["engine"] == CsvEngine.PANDAS.value].set_index("market")["sec"]
+    )
+    results["speedup"] = (baseline / results["sec"]).round(2)
+    return results
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compare CSV engines per market.")
+    parser.add_argument(
+        "market",
+        type=str,
+        nargs="+",
+        choices=SUPPORTED_MARKETS,
+        help="Market name strings",
+    )
+    parser.add_argument(
+        "--sample_rate",
+        type=int,
+        default=1,
+        help="Sample rate for trips, default 1",
+    )
+    parser.add_argument(
+        "--start_date",
+        type=pd.Timestamp,
+        default=None,
+        help="Only parse files dated on or after this date",
+    )
+    parser.add_argument(
+        "--end_date",
+        type=pd.Timestamp,
+        default=None,
+        help="Only parse files dated before this date",
+    )
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.WARNING)
+    print(
+        benchmark_csv_engines(
+            args.market,
+            sample_rate=args.sample_rate,
+            date_range=DateRange(start=args.start_date, end=args.end_date),
+        ).to_string(index=False)
+    )
@@ -1,18 +1,25 @@
 import argparse
+from typing import Optional
 
 import pandas as pd
 
 from opendata.sources.bikeshare import SUPPORTED_MARKETS
+from opendata.sources.bikeshare.aggregates import load_all_trip_counts
 
 
-def export_total_for_year(year: int) -> None:
-    totals = []
+def export_total_for_year(year: int, workers: Optional[int] = None) -> None:
+    # Markets without stored counts are counted from their output in parallel
+    counts = load_all_trip_counts(SUPPORTED_MARKETS, workers=workers)
+    in_year = counts[pd.to_datetime(counts["date"]).dt.year == year]
 
-    for market in SUPPORTED_MARKETS:
-        df = pd.read_csv(f"{market}.csv")
-        totals.append([market, len(df[df["started_at"].str.contains(str(year))])])
-
-    totals_df = pd.DataFrame(totals, columns=["system", "count"])
+    totals_df = (
+        in_year.groupby("market")["trips"]
+        .sum()
+        .reindex(counts["market"].unique(), fill_value=0)
+        .rename_axis("system")
+        .rename("count")
+        .reset_index()
+    )
     totals_df.to_csv("totals.csv", index=False)
 
 
@@ -21,5 +28,11 @@ if __name__ == "__main__":
         description="Calculate total rides for a given year"
     )
     parser.add_argument("year", type=int, help="year to calculate totals for")
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=None,
+        help="Processes counting markets that have no stored counts",
+    )
     args = parser.parse_args()
-    export_total_for_year(args.year)
+    export_total_for_year(args.year, workers=args.workers)
@@ -0,0 +1,63 @@
+import argparse
+import asyncio
+import importlib
+import math
+
+import pandas as pd
+
+from opendata.sources.bikeshare import get_columns_parsed
+from opendata.sources.bikeshare import SUPPORTED_MARKETS
+from opendata.sources.bikeshare.catalog import header_eras
+from opendata.sources.bikeshare.catalog import load_schema_report
+from opendata.sources.bikeshare.manifest import partition_name
+
+
+def market_schema(market: str) -> None:
+    """Print the CSV headers of a market's archives and how they drifted
+
+    Only the catalog written by earlier loads is read, no CSV is opened. The
+    listing is reused whatever its age, so this works offline.
+    """
+    trips = importlib.import_module(f"opendata.sources.bikeshare.{market}").trips
+    urls = asyncio.run(trips.async_list_urls(listing_ttl_sec=math.inf))
+    report = load_schema_report(trips.catalog_dir, urls)
+    if report.empty:
+        print(f"Nothing cataloged for {market}, load it first")
+        return
+
+    members_df = pd.DataFrame(
+        {
+            "archive": report["archive"].map(partition_name),
+            "member": report["member"],
+            "filetype": report["filetype"],
+            "rows": report["rows"],
+            "MiB": (report["size_bytes"] / 2**20).round(1),
+            "columns": report["header"].map(len),
+        }
+    )
+    print(members_df.to_string(index=False))
+    print()
+    print(header_eras(report).to_string(index=False))
+
+    columns_found = set(column for header in report["header"] for column in header)
+    parsers = trips.trips_parsers + (trips.stations_parsers or [])
+    columns_expected = get_columns_parsed(parsers)
+    never_found = sorted(columns_expected - columns_found)
+    unexpected = sorted(columns_found - columns_expected - trips.ignore_cols)
+    print()
+    print(f"Columns parsed but never found: {never_found}")
+    print(f"Columns found but not parsed: {unexpected}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        description="Report column drift across a market's cached CSVs."
+    )
+    parser.add_argument(
+        "market",
+        type=str,
+        choices=SUPPORTED_MARKETS,
+        help="Market name string",
+    )
+    args = parser.parse_args()
+    market_schema(args.market)
@@ -2,22 +2,357 @@ import argparse
 import asyncio
 import importlib
 import logging
+import os
+import time
+from concurrent.futures import Executor
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import replace
+from enum import Enum
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
 
+import pandas as pd
+
+from opendata.sources.bikeshare import parse_executor
 from opendata.sources.bikeshare import SUPPORTED_MARKETS
+from opendata.sources.bikeshare.aggregates import DEFAULT_AGGREGATES_DIR
+from opendata.sources.bikeshare.aggregates import replace_source_counts
+from opendata.sources.bikeshare.aggregates import save_trip_counts
+from opendata.sources.bikeshare.aggregates import TripCounter
+from opendata.sources.bikeshare.budget import MarketBudget
+from opendata.sources.bikeshare.csv_readers import CsvEngine
+from opendata.sources.bikeshare.downloads import DownloadConfig
+from opendata.sources.bikeshare.downloads import DownloadScheduler
+from opendata.sources.bikeshare.downloads import RemoteVersion
+from opendata.sources.bikeshare.instrumentation import StageRecorder
+from opendata.sources.bikeshare.instrumentation import STAGES
+from opendata.sources.bikeshare.listing import DEFAULT_LISTING_TTL_SEC
+from opendata.sources.bikeshare.load_options import LoadOptions
+from opendata.sources.bikeshare.manifest import load_manifest
+from opendata.sources.bikeshare.manifest import manifest_path
+from opendata.sources.bikeshare.manifest import ManifestEntry
+from opendata.sources.bikeshare.manifest import partition_name
+from opendata.sources.bikeshare.manifest import save_manifest
+from opendata.sources.bikeshare.parquet_output import DEFAULT_PARQUET_ROOT
+from opendata.sources.bikeshare.parquet_output import market_partition_dir
+from opendata.sources.bikeshare.parquet_output import PartitionedParquetWriter
+from opendata.sources.bikeshare.parquet_output import trips_arrow_schema
+from opendata.sources.bikeshare.parsed_cache import fingerprint
+from opendata.sources.bikeshare.periods import DateRange
+from opendata.sources.bikeshare.sample_targets import SampleTarget
+from opendata.sources.bikeshare.sampling import SampleMethod
+
+logger = logging.getLogger(__name__)
+
+ALL_MARKETS = "all"
+
+
+class OutputFormat(Enum):
+    CSV = "csv"  # a single <market>.csv
+    PARQUET = "parquet"  # <output_dir>/market=<market>/year=<year>/month=<month>/
+
+
+@dataclass
+class ExportOptions:
+    sample_rate: int = 1000
+    chunksize: Optional[int] = None
+    sample_method: SampleMethod = SampleMethod.SYSTEMATIC
+    sample_seed: Optional[int] = None
+    sample_size: Optional[int] = None
+    workers: int = 1
+    parsed_cache: bool = True
+    compact: bool = False
+    refresh_listing: bool = False
+    download_config: Optional[DownloadConfig] = None
+    incremental: bool = False
+    remote_zip: bool = False
+    date_range: Optional[DateRange] = None
+    output_format: OutputFormat = OutputFormat.CSV
+    output_dir: str = DEFAULT_PARQUET_ROOT
+    aggregates_dir: str = DEFAULT_AGGREGATES_DIR
+    engine: CsvEngine = CsvEngine.PANDAS
+    memory_budget_gb: Optional[float] = None
+    sample_target: Optional[SampleTarget] = None
+    metrics_dir: Optional[str] = None
+    profile_stage: Optional[str] = None
+
+    @property
+    def listing_ttl_sec(self) -> float:
+        return 0 if self.refresh_listing else DEFAULT_LISTING_TTL_SEC
+
+    def stage_recorder(self, market: str) -> Optional[StageRecorder]:
+        if self.metrics_dir is None:
+            return None
+        return StageRecorder(
+            profile_stage=self.profile_stage,
+            profile_path=os.path.join(
+                self.metrics_dir, f"{market}.{self.profile_stage}.prof"
+            )
+            if self.profile_stage
+            else None,
+        )
+
+    @property
+    def partition_settings(self) -> str:
+        """Fingerprint of the options shaping the trips of an incremental partition"""
+        return fingerprint(
+            self.sample_rate,
+            self.sample_method,
+            self.sample_seed,
+            self.sample_size,
+            self.compact,
+            self.engine,
+        )
+
+    @property
+    def memory_budget_bytes(self) -> Optional[int]:
+        if self.memory_budget_gb is None:
+            return None
+        return int(self.memory_budget_gb * 2**30)
+
+    def load_options(self) -> LoadOptions:
+        return LoadOptions(
+            sample_rate=self.sample_rate,
+            sample_method=self.sample_method,
+            sample_seed=self.sample_seed,
+            sample_size=self.sample_size,
+            sample_target=self.sample_target,
+            memory_budget_bytes=self.memory_budget_bytes,
+            date_range=self.date_range,
+            compact=self.compact,
+            engine=self.engine,
+            workers=self.workers,
+            parsed_cache=self.parsed_cache,
+            listing_ttl_sec=self.listing_ttl_sec,
+            download_config=self.download_config,
+            remote_zip=self.remote_zip,
+        )
+
 
+@dataclass
+class MarketSummary:
+    market: str
+    trips: int = 0
+    output: Optional[str] = None
+    elapsed_sec: float = 0.0
+    error: Optional[str] = None
 
-def market_to_csv(market: str, sample_rate: int) -> None:
+
+async def async_market_to_csv(
+    market: str,
+    options: ExportOptions,
+    scheduler: Optional[DownloadScheduler] = None,
+    executor: Optional[Executor] = None,
+) -> MarketSummary:
+    """Load a market and write its trips, sharing downloads and parsing if given
+
+    Writing runs in a thread so other markets keep downloading meanwhile. With a
+    metrics_dir, the stages of the load are reported to <market>.json there.
+    """
     trips = importlib.import_module(f"opendata.sources.bikeshare.{market}").trips
+    started_at = time.monotonic()
+    recorder = options.stage_recorder(market)
+
+    if options.incremental:
+        # One CSV per archive, so new months are added without rewriting old ones.
+        # Partitions written with other settings are redone, so the market's trips
+        # are never a mix of samples taken at different rates.
+        manifest_file = manifest_path(market)
+        manifest = load_manifest(manifest_file)
+        settings = options.partition_settings
+        known_versions = {
+            url: entry.version
+            for url, entry in manifest.items()
+            if os.path.exists(entry.partition) and entry.settings == settings
+        }
+        changed_trips, _ = await trips.async_load_changed(
+            known_versions,
+            options.load_options(),
+            scheduler=scheduler,
+            executor=executor,
+        )
+
+        def write_changed() -> int:
+            trips_written = 0
+            os.makedirs(market, exist_ok=True)
+            for cached_file_info, trips_df in changed_trips:
+                url = cached_file_info.remote_path
+                partition = os.path.join(market, f"{partition_name(url)}.csv")
+                trips_df.to_csv(partition)
+                trips_written += len(trips_df)
+                counter = TripCounter()
+                counter.add(trips_df)
+                replace_source_counts(
+                    options.aggregates_dir,
+                    market,
+                    {partition: counter.result(market, partition)},
+                    current_sources={entry.partition for entry in manifest.values()},
+                )
+
+                version = cached_file_info.version or RemoteVersion()
+                manifest[url] = ManifestEntry(
+                    url=url,
+                    partition=partition,
+                    etag=version.etag,
+                    last_modified=version.last_modified,
+                    settings=settings,
+                )
+                # Saved after every archive so an interrupted run keeps its progress
+                save_manifest(manifest_file, manifest)
+                print(f"Trip file written to {partition}")
+            return trips_written
+
+        return MarketSummary(
+            market=market,
+            trips=await asyncio.to_thread(write_changed),
+            output=market,
+            elapsed_sec=time.monotonic() - started_at,
+        )
+
+    trip_chunks: Iterator[pd.DataFrame]
+    if options.chunksize:
+        # Stream chunks straight to disk so memory stays flat on full histories
+        trip_chunks, _ = await trips.async_load_chunks(
+            options.load_options(),
+            chunksize=options.chunksize,
+            scheduler=scheduler,
+            executor=executor,
+            recorder=recorder,
+        )
+    else:
+        # Sample 1 out of 1000 for better memory performance
+        trips_df, _ = await trips.async_load(
+            options=options.load_options(),
+            scheduler=scheduler,
+            executor=executor,
+            recorder=recorder,
+        )
+        trip_chunks = iter([trips_df])
+
+    def write_chunks() -> Tuple[str, int]:
+        # Trip counts are kept alongside the output so rollups don't rescan it
+        counter = TripCounter()
+        trips_written = 0
+        if options.output_format == OutputFormat.PARQUET:
+            source = market_partition_dir(options.output_dir, market)
+            schema = trips_arrow_schema(
+                trips.trips_parsers, downcast=options.memory_budget_bytes is not None
+            )
+            with PartitionedParquetWriter(options.output_dir, market, schema) as writer:
+                for chunk in trip_chunks:
+                    writer.write(chunk)
+                    counter.add(chunk)
+                    trips_written += len(chunk)
+        else:
+            source = f"{market}.csv"
+            for i, chunk in enumerate(trip_chunks):
+                chunk.to_csv(source, mode="w" if i == 0 else "a", header=i == 0)
+                counter.add(chunk)
+                trips_written += len(chunk)
+
+        save_trip_counts(options.aggregates_dir, market, counter.result(market, source))
+        print(f"Trip file written to {source}")
+        return source, trips_written
+
+    source, trips_written = await asyncio.to_thread(write_chunks)
+    if recorder:
+        assert options.metrics_dir
+        report_path = os.path.join(options.metrics_dir, f"{market}.json")
+        recorder.write_report(report_path)
+        print(f"Stage metrics written to {report_path}")
+        profile_path = recorder.save_profile()
+        if profile_path:
+            print(f"Profile of {options.profile_stage} written to {profile_path}")
+    return MarketSummary(
+        market=market,
+        trips=trips_written,
+        output=source,
+        elapsed_sec=time.monotonic() - started_at,
+    )
+
 
+def setup_logging() -> None:
     logging.basicConfig(
         format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
         level=logging.INFO,
     )
 
-    # Sample 1 out of 1000 for better memory performance
-    trips_df, _ = asyncio.run(trips.async_load(trip_sample_rate=sample_rate))
-    trips_df.to_csv(f"{market}.csv")
-    print(f"Sampled trip file written to {market}.csv")
+
+def market_to_csv(
+    market: str,
+    sample_rate: Optional[int] = None,
+    chunksize: Optional[int] = None,
+    options: Optional[ExportOptions] = None,
+) -> None:
+    """Export a market with options, or the default ones
+
+    sample_rate and chunksize, the arguments this took before ExportOptions,
+    override those of options when given.
+    """
+    setup_logging()
+    options = options or ExportOptions()
+    if sample_rate is not None:
+        options = replace(options, sample_rate=sample_rate)
+    if chunksize is not None:
+        options = replace(options, chunksize=chunksize)
+    asyncio.run(async_market_to_csv(market, options))
+
+
+async def async_markets_to_csv(
+    markets: Iterable[str],
+    options: ExportOptions,
+    max_markets: int = 2,
+    max_rss_bytes: Optional[int] = None,
+) -> List[MarketSummary]:
+    """Export several markets at once over one connection pool and one parse pool
+
+    At most max_markets load at a time, and no new one starts while this process
+    uses more than max_rss_bytes. A failing market doesn't stop the others.
+    """
+    scheduler = DownloadScheduler(options.download_config or DownloadConfig())
+    budget = MarketBudget(max_markets=max_markets, max_rss_bytes=max_rss_bytes)
+
+    async def export(market: str, executor: Executor) -> MarketSummary:
+        async with budget.slot():
+            logger.info(f"Exporting {market}")
+            started_at = time.monotonic()
+            try:
+                return await async_market_to_csv(
+                    market, options, scheduler=scheduler, executor=executor
+                )
+            except Exception as e:
+                logger.exception(f"Failed to export {market}")
+                return MarketSummary(
+                    market=market,
+                    elapsed_sec=time.monotonic() - started_at,
+                    error=f"{type(e).__name__}: {e}",
+                )
+
+    with parse_executor(options.workers) as executor:
+        async with scheduler.session():
+            return await asyncio.gather(
+                *[export(market, executor) for market in markets]
+            )
+
+
+def markets_to_csv(
+    markets: Iterable[str],
+    options: ExportOptions,
+    max_markets: int = 2,
+    max_rss_bytes: Optional[int] = None,
+) -> None:
+    setup_logging()
+    summaries = asyncio.run(
+        async_markets_to_csv(
+            markets, options, max_markets=max_markets, max_rss_bytes=max_rss_bytes
+        )
+    )
+    summary_df = pd.DataFrame([asdict(summary) for summary in summaries])
+    print(summary_df.to_string(index=False))
 
 
 if __name__ == "__main__":
@@ -26,9 +361,10 @@ if __name__ == "__main__":
     parser.add_argument(
         "market",
         type=str,
+        nargs="+",
         # valdate market string
-        choices=SUPPORTED_MARKETS,
-        help="Market name string",
+        choices=sorted(SUPPORTED_MARKETS) + [ALL_MARKETS],
+        help="Market name strings, or all",
     )
     parser.add_argument(
         "--sample_rate",
@@ -36,5 +372,217 @@ if __name__ == "__main__":
         default=1000,
         help="Sample rate for trips, default 1000",
     )
+    parser.add_argument(
+        "--chunksize",
+        type=int,
+        default=None,
+        help="Stream trips in chunks of this many rows instead of loading at once",
+    )
+    parser.add_argument(
+        "--sample_method",
+        type=str,
+        choices=[method.value for method in SampleMethod],
+        default=SampleMethod.SYSTEMATIC.value,
+        help="How trips are sampled: every Nth row, randomly, or a fixed reservoir",
+    )
+    parser.add_argument(
+        "--seed",
+        type=int,
+        default=None,
+        help="Seed for random and reservoir sampling, for reproducible samples",
+    )
+    parser.add_argument(
+        "--sample_size",
+        type=int,
+        default=None,
+        help="Trips kept per file by reservoir sampling",
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="Parse CSVs in a pool of this many processes, default 1",
+    )
+    parser.add_argument(
+        "--no_parsed_cache",
+        action="store_true",
+        help="Re-parse every CSV instead of reusing previously parsed files",
+    )
+    parser.add_argument(
+        "--compact",
+        action="store_true",
+        help="Store low-cardinality columns like station names as categoricals",
+    )
+    parser.add_argument(
+        "--refresh_listing",
+        action="store_true",
+        help="Look for new files even if the data page was listed recently",
+    )
+    parser.add_argument(
+        "--connections_per_host",
+        type=int,
+        default=DownloadConfig.max_connections_per_host,
+        help="Concurrent downloads from each host",
+    )
+    parser.add_argument(
+        "--max_download_mib_per_sec",
+        type=float,
+        default=None,
+        help="Cap on total download bandwidth in MiB (2**20 bytes) per second",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Write one CSV per archive to a market directory, redoing only new or changed archives",
+    )
+    parser.add_argument(
+        "--remote_zip",
+        action="store_true",
+        help="Fetch only the CSVs inside each archive that will be parsed",
+    )
+    parser.add_argument(
+        "--start_date",
+        type=pd.Timestamp,
+        default=None,
+        help="Only trips started on or after this date, skipping older files",
+    )
+    parser.add_argument(
+        "--end_date",
+        type=pd.Timestamp,
+        default=None,
+        help="Only trips started before this date, skipping newer files",
+    )
+    parser.add_argument(
+        "--format",
+        type=str,
+        choices=[output_format.value for output_format in OutputFormat],
+        default=OutputFormat.CSV.value,
+        help="Write one CSV, or Parquet files partitioned by market, year and month",
+    )
+    parser.add_argument(
+        "--output_dir",
+        type=str,
+        default=DEFAULT_PARQUET_ROOT,
+        help="Where Parquet partitions are written, default trips",
+    )
+    parser.add_argument(
+        "--engine",
+        type=str,
+        choices=[engine.value for engine in CsvEngine],
+        default=CsvEngine.PANDAS.value,
+        help="CSV parser, pyarrow parses each file on several threads",
+    )
+    parser.add_argument(
+        "--max_markets",
+        type=int,
+        default=2,
+        help="Markets loaded at the same time when exporting several, default 2",
+    )
+    parser.add_argument(
+        "--max_memory_gb",
+        type=float,
+        default=None,
+        help="Hold back further markets while memory use is above this",
+    )
+    parser.add_argument(
+        "--memory_budget_gb",
+        type=float,
+        default=None,
+        help="Downcast trip columns, and raise the sample rate if needed, so each market's trips fit in this",
+    )
+    parser.add_argument(
+        "--target_rows",
+        type=int,
+        default=None,
+        help="Choose each file's sample rate to keep about this many trips, spread evenly over months",
+    )
+    parser.add_argument(
+        "--target_rows_per_month",
+        type=int,
+        default=None,
+        help="Choose each file's sample rate to keep about this many trips per month",
+    )
+    parser.add_argument(
+        "--metrics_dir",
+        type=str,
+        default=None,
+        help="Write the time, rows, bytes and memory of each load stage per market to <market>.json here",
+    )
+    parser.add_argument(
+        "--profile_stage",
+        type=str,
+        choices=STAGES,
+        default=None,
+        help="Also write a cProfile dump of this stage to <market>.<stage>.prof in --metrics_dir",
+    )
     args = parser.parse_args()
-    market_to_csv(args.market, args.sample_rate)
+    if (
+        args.sample_method == SampleMethod.RESERVOIR.value
+        and not args.sample_size
+        and not (args.target_rows or args.target_rows_per_month)
+    ):
+        parser.error("--sample_method reservoir needs --sample_size")
+    if args.incremental and args.format != OutputFormat.CSV.value:
+        parser.error("--incremental only writes CSV")
+    if args.incremental and (args.start_date or args.end_date):
+        parser.error("--incremental always covers every archive")
+    if args.memory_budget_gb and (args.chunksize or args.incremental):
+        parser.error("--memory_budget_gb only applies to loading trips all at once")
+    if args.target_rows and args.target_rows_per_month:
+        parser.error("--target_rows and --target_rows_per_month are exclusive")
+    if (args.target_rows or args.target_rows_per_month) and (
+        args.memory_budget_gb or args.incremental
+    ):
+        parser.error(
+            "Sample targets don't apply to --memory_budget_gb or --incremental"
+        )
+    if args.profile_stage and not args.metrics_dir:
+        parser.error("--profile_stage needs --metrics_dir")
+    if args.metrics_dir and args.incremental:
+        parser.error("--metrics_dir doesn't apply to --incremental")
+
+    options = ExportOptions(
+        sample_rate=args.sample_rate,
+        chunksize=args.chunksize,
+        sample_method=SampleMethod(args.sample_method),
+        sample_seed=args.seed,
+        sample_size=args.sample_size,
+        workers=args.workers,
+        parsed_cache=not args.no_parsed_cache,
+        compact=args.compact,
+        refresh_listing=args.refresh_listing,
+        download_config=DownloadConfig(
+            max_connections_per_host=args.connections_per_host,
+            max_bytes_per_sec=args.max_download_mib_per_sec * 2**20
+            if args.max_download_mib_per_sec
+            else None,
+        ),
+        incremental=args.incremental,
+        remote_zip=args.remote_zip,
+        date_range=DateRange(start=args.start_date, end=args.end_date)
+        if args.start_date or args.end_date
+        else None,
+        output_format=OutputFormat(args.format),
+        output_dir=args.output_dir,
+        engine=CsvEngine(args.engine),
+        memory_budget_gb=args.memory_budget_gb,
+        sample_target=SampleTarget(
+            rows=args.target_rows, rows_per_month=args.target_rows_per_month
+        )
+        if args.target_rows or args.target_rows_per_month
+        else None,
+        metrics_dir=args.metrics_dir,
+        profile_stage=args.profile_stage,
+    )
+    markets = sorted(SUPPORTED_MARKETS) if ALL_MARKETS in args.market else args.market
+    if len(markets) == 1:
+        market_to_csv(markets[0], options=options)
+    else:
+        markets_to_csv(
+            markets,
+            options,
+            max_markets=args.max_markets,
+            max_rss_bytes=int(args.max_memory_gb * 2**30)
+            if args.max_memory_gb
+            else None,
+        )
@@ -0,0 +1,181 @@
+"""Trip counts per market, day, user type and rideable type
+
+Counts are stored while trips are written, so rollups like yearly totals read a
+few thousand rows instead of every trip. Each row also records the output file
+its trips were written to, which lets incremental runs replace the counts of
+just the files they rewrite.
+"""
+import glob
+import logging
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Collection
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+
+import pandas as pd
+
+from opendata.sources.bikeshare.parquet_output import DEFAULT_PARQUET_ROOT
+from opendata.sources.bikeshare.parquet_output import market_partition_dir
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_AGGREGATES_DIR = "aggregates"
+
+TRIP_COUNT_KEYS = ["date", "user_type", "rideable_type"]
+TRIP_COUNT_COLUMNS = ["market", *TRIP_COUNT_KEYS, "source", "trips"]
+
+
+def count_trips(trips_df: pd.DataFrame) -> pd.DataFrame:
+    """Trips per day, user type and rideable type, nulls counted as their own group"""
+    keys = pd.DataFrame(
+        {
+            "date": trips_df["started_at"].dt.normalize(),
+            "user_type": trips_df["user_type"].astype("string"),
+            "rideable_type": trips_df["rideable_type"].astype("string"),
+        }
+    )
+    return (
+        keys.groupby(TRIP_COUNT_KEYS, dropna=False).size().rename("trips").reset_index()
+    )
+
+
+def sum_counts(counts: List[pd.DataFrame], keys: List[str]) -> pd.DataFrame:
+    return pd.concat(counts).groupby(keys, dropna=False)["trips"].sum().reset_index()
+
+
+class TripCounter:
+    """Count trips chunk by chunk as they are written"""
+
+    def __init__(self) -> None:
+        self.counts: Optional[pd.DataFrame] = None
+
+    def add(self, trips_df: pd.DataFrame) -> None:
+        if trips_df.empty:
+            return
+
+        counts = count_trips(trips_df)
+        if self.counts is not None:
+            # Summed right away so memory stays at one row per day and type
+            counts = sum_counts([self.counts, counts], TRIP_COUNT_KEYS)
+        self.counts = counts
+
+    def result(self, market: str, source: str) -> pd.DataFrame:
+        if self.counts is None:
+            return pd.DataFrame(columns=TRIP_COUNT_COLUMNS)
+
+        counts = self.counts.copy()
+        counts["market"] = market
+        counts["source"] = source
+        return counts[TRIP_COUNT_COLUMNS]
+
+
+def trip_counts_path(root: str, market: str) -> str:
+    return os.path.join(root, f"{market}.parquet")
+
+
+def load_trip_counts(root: str, market: str) -> Optional[pd.DataFrame]:
+    path = trip_counts_path(root, market)
+    if not os.path.exists(path):
+        return None
+    return pd.read_parquet(path)
+
+
+def save_trip_counts(root: str, market: str, counts: pd.DataFrame) -> None:
+    os.makedirs(root, exist_ok=True)
+    path = trip_counts_path(root, market)
+    tmp_path = path + ".tmp"
+    counts[TRIP_COUNT_COLUMNS].to_parquet(tmp_path, index=False)
+    os.replace(tmp_path, path)
+
+
+def replace_source_counts(
+    root: str,
+    market: str,
+    counts_by_source: Dict[str, pd.DataFrame],
+    current_sources: Optional[Collection[str]] = None,
+) -> None:
+    """Swap in new counts for some output files, keeping those of the others
+
+    With current_sources, counts of output files not in it are dropped, e.g. those
+    of an earlier run that wrote the market in another format.
+    """
+    existing = load_trip_counts(root, market)
+    kept = []
+    if existing is not None:
+        keep = ~existing["source"].isin(counts_by_source.keys())
+        if current_sources is not None:
+            keep &= existing["source"].isin(current_sources)
+        kept.append(existing[keep])
+    save_trip_counts(
+        root, market, pd.concat([*kept, *counts_by_source.values()], ignore_index=True)
+    )
+
+
+def compute_trip_counts(
+    market: str, parquet_root: str = DEFAULT_PARQUET_ROOT
+) -> Optional[pd.DataFrame]:
+    """Count trips from a market's written output, for runs that stored no counts
+
+    The CSVs incremental runs write per archive are each counted as a source of
+    their own, like the counts those runs store.
+    """
+    columns = ["started_at", "user_type", "rideable_type"]
+    parquet_dir = market_partition_dir(parquet_root, market)
+    csv_path = f"{market}.csv"
+    if os.path.exists(parquet_dir):
+        sources = [parquet_dir]
+    elif os.path.exists(csv_path):
+        sources = [csv_path]
+    else:
+        sources = sorted(glob.glob(os.path.join(market, "*.csv")))
+    if not sources:
+        logger.warning(f"No trips written for {market}, can't count them")
+        return None
+
+    counts = []
+    for source in sources:
+        if source == parquet_dir:
+            trips_df = pd.read_parquet(source, columns=columns)
+        else:
+            # Archives holding only stations are written as CSVs without columns
+            trips_df = pd.read_csv(source, usecols=lambda column: column in columns)
+            if not trips_df.empty:
+                trips_df["started_at"] = pd.to_datetime(trips_df["started_at"])
+        counter = TripCounter()
+        counter.add(trips_df)
+        counts.append(counter.result(market, source))
+    return pd.concat(counts, ignore_index=True)
+
+
+def load_all_trip_counts(
+    markets: Iterable[str],
+    root: str = DEFAULT_AGGREGATES_DIR,
+    parquet_root: str = DEFAULT_PARQUET_ROOT,
+    workers: Optional[int] = None,
+) -> pd.DataFrame:
+    """Stored trip counts of every market, computing missing ones in parallel"""
+    counts = {market: load_trip_counts(root, market) for market in markets}
+    missing = [
+        market for market, market_counts in counts.items() if market_counts is None
+    ]
+
+    if missing:
+        logger.info(f"Counting trips of {', '.join(missing)} from their output")
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            computed = executor.map(
+                compute_trip_counts, missing, [parquet_root] * len(missing)
+            )
+            for market, market_counts in zip(missing, computed):
+                if market_counts is not None:
+                    save_trip_counts(root, market, market_counts)
+                counts[market] = market_counts
+
+    found = [
+        market_counts for market_counts in counts.values() if market_counts is not None
+    ]
+    if not found:
+        return pd.DataFrame(columns=TRIP_COUNT_COLUMNS)
+    return pd.concat(found, ignore_index=True)
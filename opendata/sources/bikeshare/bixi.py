@@ -25,6 +25,7 @@ trips = BikeshareCSVDataSource(
         user_type__cols=["is_member"],
         bike_id__cols=[],
         birth_year__cols=[],
+        datetime_units={"STARTTIMEMS": "ms", "ENDTIMEMS": "ms"},
     ),
     stations_parsers=create_stations_parsers(
         id__cols=["pk", "code", "Code"],
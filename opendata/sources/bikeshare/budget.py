@@ -0,0 +1,74 @@
+import asyncio
+import contextlib
+import os
+from typing import AsyncIterator
+from typing import Optional
+
+
+def current_rss_bytes() -> Optional[int]:
+    """Resident memory of this process, None where /proc isn't available"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        return None
+
+
+def peak_rss_bytes() -> Optional[int]:
+    """Highest resident memory of this process so far, None where /proc isn't available"""
+    try:
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError):
+        pass
+    return None
+
+
+class MarketBudget:
+    """Limit how many markets load at once, holding new ones back while memory is high
+
+    A market is always admitted when none are running, so a market bigger than the
+    budget still runs, just on its own. Memory is this process's resident set,
+    parse workers aren't counted since their results come back here anyway.
+    """
+
+    def __init__(
+        self,
+        max_markets: int,
+        max_rss_bytes: Optional[int] = None,
+        poll_sec: float = 1.0,
+    ):
+        self.max_markets = max_markets
+        self.max_rss_bytes = max_rss_bytes
+        self.poll_sec = poll_sec
+        self.running = 0
+        self.condition = asyncio.Condition()
+
+    def has_room(self) -> bool:
+        if self.running == 0:
+            return True
+        elif self.running >= self.max_markets:
+            return False
+
+        rss = current_rss_bytes()
+        return self.max_rss_bytes is None or rss is None or rss < self.max_rss_bytes
+
+    @contextlib.asynccontextmanager
+    async def slot(self) -> AsyncIterator[None]:
+        async with self.condition:
+            while not self.has_room():
+                # Memory drops without a notification, so check it periodically
+                try:
+                    await asyncio.wait_for(self.condition.wait(), self.poll_sec)
+                except asyncio.TimeoutError:
+                    pass
+            self.running += 1
+
+        try:
+            yield
+        finally:
+            async with self.condition:
+                self.running -= 1
+                self.condition.notify_all()
@@ -0,0 +1,196 @@
+"""Headers, row counts and sizes of the CSVs inside cached archives
+
+Telling trips from stations only needs a CSV's header, but reading it means
+opening every member of every archive on each run. The catalog keeps what was
+found per archive for as long as the archive is unchanged, so reruns skip the
+sniffing and column drift can be reported without opening any CSV. Sizes come
+from the zip directory, and rows are counted by the first load that reads a
+CSV in full, so cataloging never reads more than a header.
+"""
+import json
+import logging
+import os
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+
+import numpy as np
+import pandas as pd
+
+from opendata.sources.bikeshare.downloads import CachedFileInfo
+from opendata.sources.bikeshare.downloads import file_path_for_url
+from opendata.sources.bikeshare.parsed_cache import archive_identity
+from opendata.sources.bikeshare.periods import name_period
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class MemberSchema:
+    header: List[str]
+    filetype: str  # FileType name, as classified when cataloged
+    rows: Optional[int]  # None until a load reads the whole CSV
+    size_bytes: int  # uncompressed
+
+
+@dataclass
+class ArchiveCatalog:
+    remote_path: str
+    identity: List[Any]
+    members: Dict[str, MemberSchema] = field(default_factory=dict)
+
+
+def archive_key(cached_file_info: CachedFileInfo) -> List[Any]:
+    """The remote version of an archive when known, else its size and mtime
+
+    Remote zips fetched member by member change on disk whenever members are
+    added, their version keeps the members cataloged so far valid.
+    """
+    version = cached_file_info.version
+    if version and (version.etag or version.last_modified):
+        return [version.etag, version.last_modified]
+    return list(archive_identity(cached_file_info.local_path))
+
+
+def catalog_path(catalog_dir: str, remote_path: str) -> str:
+    return file_path_for_url(remote_path, catalog_dir) + ".json"
+
+
+def read_catalog(path: str) -> Optional[ArchiveCatalog]:
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        raw = json.load(f)
+    return ArchiveCatalog(
+        remote_path=raw["remote_path"],
+        identity=raw["identity"],
+        members={
+            name: MemberSchema(**member) for name, member in raw["members"].items()
+        },
+    )
+
+
+def write_catalog(path: str, catalog: ArchiveCatalog) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(asdict(catalog), f)
+    os.replace(tmp_path, path)
+
+
+class SchemaCatalog:
+    """The catalogs of a data directory's archives, loaded as they're needed"""
+
+    def __init__(self, catalog_dir: str):
+        self.catalog_dir = catalog_dir
+        self.archives: Dict[str, ArchiveCatalog] = {}
+        self.changed: Set[str] = set()
+
+    def archive(self, cached_file_info: CachedFileInfo) -> ArchiveCatalog:
+        remote_path = cached_file_info.remote_path
+        if remote_path not in self.archives:
+            identity = archive_key(cached_file_info)
+            catalog = read_catalog(catalog_path(self.catalog_dir, remote_path))
+            if catalog is None or catalog.identity != identity:
+                catalog = ArchiveCatalog(remote_path=remote_path, identity=identity)
+            self.archives[remote_path] = catalog
+        return self.archives[remote_path]
+
+    def get(
+        self, cached_file_info: CachedFileInfo, name: str
+    ) -> Optional[MemberSchema]:
+        return self.archive(cached_file_info).members.get(name)
+
+    def add(
+        self, cached_file_info: CachedFileInfo, name: str, schema: MemberSchema
+    ) -> None:
+        self.archive(cached_file_info).members[name] = schema
+        self.changed.add(cached_file_info.remote_path)
+
+    def save(self) -> None:
+        for remote_path in self.changed:
+            write_catalog(
+                catalog_path(self.catalog_dir, remote_path), self.archives[remote_path]
+            )
+        self.changed = set()
+
+
+def period_start(name: str) -> Optional[pd.Timestamp]:
+    period = name_period(name)
+    return period[0] if period else None
+
+
+def load_schema_report(catalog_dir: str, remote_paths: List[str]) -> pd.DataFrame:
+    """One row per cataloged CSV of the given archives, oldest first
+
+    Age is judged by the dates in member names, or else archive names, and CSVs
+    without any keep their listing order at the end.
+    """
+    rows = []
+    for remote_path in remote_paths:
+        catalog = read_catalog(catalog_path(catalog_dir, remote_path))
+        if catalog is None:
+            logger.warning(f"{remote_path} isn't cataloged yet, load it first")
+            continue
+
+        for name, member in sorted(catalog.members.items()):
+            rows.append(
+                {
+                    "archive": remote_path,
+                    "member": name,
+                    **asdict(member),
+                    "header": tuple(member.header),
+                }
+            )
+
+    report = pd.DataFrame(
+        rows,
+        columns=["archive", "member", "header", "filetype", "rows", "size_bytes"],
+    ).astype({"rows": "Int64"})
+    starts = pd.DatetimeIndex(
+        [
+            period_start(member) or period_start(archive)
+            for archive, member in zip(report["archive"], report["member"])
+        ]
+    )
+    # numpy sorts NaT last
+    order = np.argsort(starts.to_numpy(), kind="stable")
+    return report.iloc[order].reset_index(drop=True)
+
+
+def header_eras(report: pd.DataFrame) -> pd.DataFrame:
+    """Runs of consecutive CSVs of a file type sharing a header, and what changed
+
+    Each era lists the columns added and removed since the previous era of the
+    same file type.
+    """
+    eras = []
+    for filetype, members in report.groupby("filetype", sort=False):
+        previous: Optional[List[str]] = None
+        for _, run in members.groupby(
+            (members["header"] != members["header"].shift()).cumsum(), sort=False
+        ):
+            header = run["header"].iloc[0]
+            eras.append(
+                {
+                    "filetype": filetype,
+                    "first_member": run["member"].iloc[0],
+                    "last_member": run["member"].iloc[-1],
+                    "members": len(run),
+                    "rows": run["rows"].sum(),
+                    "added": []
+                    if previous is None
+                    else sorted(set(header) - set(previous)),
+                    "removed": []
+                    if previous is None
+                    else sorted(set(previous) - set(header)),
+                }
+            )
+            previous = header
+    return pd.DataFrame(eras)
@@ -0,0 +1,169 @@
+"""Map parsed CSVs to the standard columns and combine them
+
+Each CSV, or chunk of one, is mapped on its own before anything is
+concatenated, so frames never carry the union of every era's headers.
+"""
+import logging
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Set
+
+import numpy as np
+import pandas as pd
+
+from opendata.sources.bikeshare.datetimes import parse_datetime_source
+from opendata.sources.bikeshare.instrumentation import record_stage
+from opendata.sources.bikeshare.instrumentation import StageRecorder
+from opendata.sources.bikeshare.parsers import ColumnParser
+
+logger = logging.getLogger(__name__)
+
+
+def merge_columns(
+    parsers: List[ColumnParser],
+    df: pd.DataFrame,
+    compact: bool = False,
+    guessed_formats: Optional[Dict[str, Optional[str]]] = None,
+    recorder: Optional[StageRecorder] = None,
+) -> pd.DataFrame:
+    """Map a CSV's columns to the standard ones, parsing datetimes as they're read
+
+    Pass the same guessed_formats for every chunk of a file to guess its datetime
+    formats only once.
+    """
+    if guessed_formats is None:
+        guessed_formats = {}
+
+    with record_stage(recorder, "merge_columns", rows_in=len(df)) as merged:
+        # Chunks and single files only carry some of the from_columns, so tolerate
+        # missing ones and fall back to an empty column of the parser's dtype
+        new_df = pd.DataFrame(index=df.index)
+        for parser in parsers:
+            assigned = False
+            col = pd.Series(None, index=df.index, dtype=parser.dtype)
+            for from_column in parser.from_columns:
+                if from_column not in df.columns:
+                    continue
+
+                values = df[from_column]
+                if parser.is_datetime:
+                    with record_stage(
+                        recorder, "parse_datetimes", rows_in=len(values)
+                    ) as parsed:
+                        values = parse_datetime_source(
+                            parser, from_column, values, guessed_formats
+                        )
+                        parsed.rows_out = int(values.notna().sum())
+
+                if not assigned:
+                    col = values
+                    assigned = True
+                else:
+                    col = col.fillna(values)
+
+            if parser.remap_values:
+                with record_stage(
+                    recorder, "remap_values", rows_in=len(col)
+                ) as remapped:
+                    col = remap_values(col, parser.remap_values)
+                    remapped.rows_out = len(col)
+
+            if compact and parser.categorical:
+                # Casting first keeps the categories typed even when the column is
+                # all null, which Parquet would otherwise read back as object
+                col = col.astype(parser.dtype).astype("category")
+
+            new_df[parser.to_column] = col
+        merged.rows_out = len(new_df)
+
+    return new_df
+
+
+def downcast_columns(parsers: List[ColumnParser], df: pd.DataFrame) -> pd.DataFrame:
+    """Cast the columns of parsers with a downcast_dtype to it
+
+    Values that don't parse as numbers, or don't fit an integer dtype, become null.
+    """
+    for parser in parsers:
+        if not parser.downcast_dtype or parser.to_column not in df.columns:
+            continue
+
+        dtype = pd.api.types.pandas_dtype(parser.downcast_dtype)
+        values = pd.to_numeric(df[parser.to_column], errors="coerce")
+        if pd.api.types.is_integer_dtype(dtype):
+            bounds = np.iinfo(getattr(dtype, "numpy_dtype", dtype))
+            values = values.round().where(values.between(bounds.min, bounds.max))
+        df[parser.to_column] = values.astype(dtype)
+
+    return df
+
+
+def concat_frames(dfs: List[pd.DataFrame]) -> pd.DataFrame:
+    """Concatenate frames, keeping categorical columns categorical
+
+    pd.concat falls back to object dtype unless every frame's categories match, so
+    each categorical column is first given the union of its categories.
+    """
+    categories: Dict[str, pd.Index] = {}
+    for df in dfs:
+        for column in df.select_dtypes("category").columns:
+            found = df[column].cat.categories
+            categories[column] = (
+                categories[column].union(found) if column in categories else found
+            )
+
+    return pd.concat(
+        [
+            df.astype(
+                {
+                    column: pd.CategoricalDtype(found)
+                    for column, found in categories.items()
+                    if column in df.columns
+                }
+            )
+            for df in dfs
+        ]
+    )
+
+
+def remap_values(series: pd.Series, remap_values: Dict[str, Set[str]]) -> pd.Series:
+    """Remap values case-insensitively, passing unknown values through lowercased
+
+    Only the distinct values are remapped in Python, then broadcast back to every
+    row through their factorized codes.
+    """
+
+    def remap_one(cur_val: Optional[str]) -> Optional[str]:
+        if not isinstance(cur_val, str):
+            return cur_val
+
+        cur_val = cur_val.lower()
+        for to_val, from_vals in remap_values.items():
+            if cur_val in from_vals:  # from_vals should be lowercase already
+                return to_val if to_val != "N/A" else None
+
+        return cur_val
+
+    if isinstance(series.dtype, pd.CategoricalDtype):
+        codes, uniques = series.cat.codes.to_numpy(), series.cat.categories
+    else:
+        codes, uniques = pd.factorize(series)
+    remapped = np.array([remap_one(value) for value in uniques] + [None], dtype=object)
+    values = remapped[codes]  # code -1 marks nulls, which hit the trailing None
+
+    # Nulls pass through unchanged, keeping NaN vs <NA> as they were
+    is_null = codes == -1
+    values[is_null] = series.to_numpy(dtype=object)[is_null]
+    return pd.Series(values, index=series.index, name=series.name, dtype=object)
+
+
+def drop_malformed_trips(df: pd.DataFrame) -> pd.DataFrame:
+    """Some markets like Niceride have null rows in the CSV"""
+    null_started_at = df["started_at"].isna()
+    count = null_started_at.sum()
+    if count > 0:
+        logger.warn(f"Dropping {count} rows missing a started_at timestamp")
+        return df[null_started_at == False]
+    else:
+        return df
@@ -0,0 +1,158 @@
+"""Sample settings chosen before a load, from how many trips each CSV holds
+
+Trips are counted from the catalog and zip directories, so a memory budget or
+a sample target sets the samples without parsing any CSV.
+"""
+import logging
+import math
+import os
+from dataclasses import replace
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from zipfile import ZipFile
+
+from opendata.sources.bikeshare.members import MemberTask
+from opendata.sources.bikeshare.memory_budget import budget_sample_rate
+from opendata.sources.bikeshare.memory_budget import bytes_per_line
+from opendata.sources.bikeshare.memory_budget import estimate_rows
+from opendata.sources.bikeshare.memory_budget import row_bytes
+from opendata.sources.bikeshare.parsers import ColumnParser
+from opendata.sources.bikeshare.parsers import FileType
+from opendata.sources.bikeshare.periods import DateRange
+from opendata.sources.bikeshare.sample_targets import estimate_file
+from opendata.sources.bikeshare.sample_targets import file_samples
+from opendata.sources.bikeshare.sample_targets import month_quota
+from opendata.sources.bikeshare.sample_targets import SampleTarget
+from opendata.sources.bikeshare.sampling import SampleConfig
+from opendata.sources.bikeshare.sampling import SampleMethod
+
+logger = logging.getLogger(__name__)
+
+
+def trip_row_bytes(
+    trip_parsers: List[ColumnParser], compact: bool = False, downcast: bool = False
+) -> int:
+    """Bytes a normalized trip takes in memory"""
+    return row_bytes(
+        (
+            parser.downcast_dtype
+            if downcast and parser.downcast_dtype
+            else parser.dtype,
+            compact and parser.categorical,
+        )
+        for parser in trip_parsers
+    )
+
+
+def estimate_trip_rows(tasks: List[MemberTask]) -> List[int]:
+    """Trips in the CSV of each task, 0 for station tables
+
+    Cataloged CSVs that were read in full count their rows, others are estimated
+    from their uncompressed size at the bytes per line of the counted ones. CSVs
+    named like station tables are left out until they're cataloged as such.
+    """
+    line_bytes = bytes_per_line(
+        task.schema
+        for task in tasks
+        if task.schema and task.schema.filetype == FileType.TRIPS.name
+    )
+
+    rows = []
+    member_sizes: Dict[str, Dict[str, int]] = {}
+    for task in tasks:
+        if task.schema is not None:
+            if task.schema.filetype != FileType.TRIPS.name:
+                rows.append(0)
+            elif task.schema.rows is None:
+                rows.append(estimate_rows(task.schema.size_bytes, line_bytes))
+            else:
+                rows.append(task.schema.rows)
+        elif "station" in os.path.basename(task.name).lower():
+            rows.append(0)
+        else:
+            local_path = task.cached_file_info.local_path
+            if local_path not in member_sizes:
+                with ZipFile(local_path) as zip:
+                    member_sizes[local_path] = {
+                        zipinfo.filename: zipinfo.file_size
+                        for zipinfo in zip.infolist()
+                    }
+            rows.append(estimate_rows(member_sizes[local_path][task.name], line_bytes))
+    return rows
+
+
+def budget_sample(
+    tasks: List[MemberTask],
+    trip_sample: SampleConfig,
+    trip_parsers: List[ColumnParser],
+    memory_budget_bytes: int,
+    compact: bool = False,
+    date_range: Optional[DateRange] = None,
+) -> SampleConfig:
+    """trip_sample, with a higher rate if downcast trips would exceed the budget
+
+    Trips are counted from the catalog and zip directories, without parsing any
+    CSV, and only the share of each CSV's months within date_range is kept.
+    Reservoir samples keep a fixed number of trips per file, so exceeding the
+    budget with them is only logged.
+    """
+    files = [
+        estimate_file(rows, task.name, task.cached_file_info.remote_path, date_range)
+        for task, rows in zip(tasks, estimate_trip_rows(tasks))
+    ]
+    trip_bytes = trip_row_bytes(trip_parsers, compact=compact, downcast=True)
+    budget_mib = memory_budget_bytes / 2**20
+
+    if trip_sample.method == SampleMethod.RESERVOIR:
+        assert trip_sample.size
+        sampled_rows = sum(
+            min(file.rows, trip_sample.size) * file.in_range for file in files
+        )
+        sampled_mib = sampled_rows * trip_bytes / 2**20
+        if sampled_mib > budget_mib:
+            logger.warning(
+                f"Sampled trips may take {sampled_mib:.0f} MiB, over the {budget_mib:.0f} MiB budget, lower the sample size"
+            )
+        return trip_sample
+
+    rows = math.ceil(sum(file.rows_in_range for file in files))
+    estimated_bytes = rows * trip_bytes
+    sample_rate = budget_sample_rate(
+        estimated_bytes, trip_sample.rate, memory_budget_bytes
+    )
+    logger.info(
+        f"About {rows} trips would take {estimated_bytes / 2**20:.0f} MiB, sampling 1 in {sample_rate} to fit {budget_mib:.0f} MiB"
+    )
+    return replace(trip_sample, rate=sample_rate)
+
+
+def target_samples(
+    tasks: List[MemberTask],
+    trip_sample: SampleConfig,
+    target: SampleTarget,
+    date_range: Optional[DateRange] = None,
+) -> Dict[Tuple[str, str], SampleConfig]:
+    """Sample settings per trip CSV, by archive and name, to keep target trips
+
+    Trips are counted from the catalog and zip directories, without parsing any
+    CSV, and each CSV's months come from its name.
+    """
+    trip_tasks = []
+    files = []
+    for task, rows in zip(tasks, estimate_trip_rows(tasks)):
+        if rows:
+            trip_tasks.append(task)
+            files.append(
+                estimate_file(
+                    rows, task.name, task.cached_file_info.remote_path, date_range
+                )
+            )
+
+    quota = month_quota(files, target)
+    logger.info(f"Keeping about {quota:.0f} trips per month from {len(files)} CSVs")
+    return {
+        (task.cached_file_info.remote_path, task.name): sample
+        for task, sample in zip(trip_tasks, file_samples(trip_sample, files, quota))
+    }
@@ -0,0 +1,104 @@
+"""Fixed-format datetime parsing of trip CSV columns
+
+pd.to_datetime without a format falls back to inferring each value when a
+column's values don't all match the format it guessed, which is slow on
+millions of rows. Here a source column's format is either declared by its
+market or guessed once per file, so the column is parsed in one vectorized pass.
+"""
+import logging
+from typing import Dict
+from typing import List
+from typing import Optional
+
+import pandas as pd
+
+from opendata.sources.bikeshare.parsers import ColumnParser
+
+logger = logging.getLogger(__name__)
+
+# Values a guessed format is checked against before it's used for a whole file
+GUESS_SAMPLE_SIZE = 100
+
+
+def guess_format(values: pd.Series) -> Optional[str]:
+    """The format most of the first non-null values match, None if there isn't one
+
+    guess_datetime_format is only public, in pandas.tseries.api, from pandas 2.1.
+    Older pandas guesses nothing, leaving every value to be inferred.
+    """
+    try:
+        from pandas.tseries.api import guess_datetime_format
+    except ImportError:
+        return None
+
+    sample = values.dropna().head(GUESS_SAMPLE_SIZE).astype(str)
+    candidates = {guess_datetime_format(value) for value in sample.unique()[:5]}
+
+    best_format, best_matches = None, len(sample) // 2
+    for datetime_format in candidates - {None}:
+        matches = pd.to_datetime(sample, format=datetime_format, errors="coerce")
+        if matches.notna().sum() > best_matches:
+            best_format, best_matches = datetime_format, matches.notna().sum()
+    return best_format
+
+
+def parse_datetimes(
+    values: pd.Series,
+    datetime_format: Optional[str] = None,
+    unit: Optional[str] = None,
+) -> pd.Series:
+    """Parse a source column, unparseable values becoming NaT
+
+    With a unit, values are numbers since the epoch. Values that don't match
+    datetime_format, like the odd row without seconds, are inferred one by one.
+    """
+    if unit:
+        return pd.to_datetime(pd.to_numeric(values, errors="coerce"), unit=unit)
+    elif datetime_format is None:
+        return pd.to_datetime(values, format="mixed", errors="coerce")
+
+    parsed = pd.to_datetime(values, format=datetime_format, errors="coerce")
+    mismatched = parsed.isna() & values.notna()
+    if mismatched.any():
+        parsed[mismatched] = pd.to_datetime(
+            values[mismatched], format="mixed", errors="coerce"
+        )
+    return parsed
+
+
+def parse_datetime_source(
+    parser: ColumnParser,
+    column: str,
+    values: pd.Series,
+    guessed_formats: Dict[str, Optional[str]],
+) -> pd.Series:
+    """Parse one datetime from_column with its declared unit or format
+
+    Guessed formats are kept in guessed_formats, so the chunks of a file share the
+    format guessed from its first chunk.
+    """
+    if parser.datetime_units and column in parser.datetime_units:
+        return parse_datetimes(values, unit=parser.datetime_units[column])
+    elif parser.datetime_formats and column in parser.datetime_formats:
+        return parse_datetimes(values, parser.datetime_formats[column])
+
+    if column not in guessed_formats:
+        guessed_formats[column] = guess_format(values)
+        logger.debug(f"Guessed format {guessed_formats[column]} for {column}")
+    return parse_datetimes(values, guessed_formats[column])
+
+
+def parse_datetime_columns(
+    parsers: List[ColumnParser], df: pd.DataFrame
+) -> pd.DataFrame:
+    for parser in parsers:
+        if not parser.is_datetime:
+            continue
+        elif pd.api.types.is_datetime64_any_dtype(df[parser.to_column]):
+            continue  # already parsed by merge_columns
+
+        df[parser.to_column] = pd.to_datetime(
+            df[parser.to_column], format="mixed", errors="coerce"
+        )
+
+    return df
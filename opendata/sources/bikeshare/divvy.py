@@ -58,6 +58,10 @@ trips = BikeshareCSVDataSource(
             "birthday",
             "05 - Member Details Member Birthday Year",
         ],
+        datetime_formats={
+            "01 - Rental Details Local Start Time": "%Y-%m-%d %H:%M:%S",
+            "01 - Rental Details Local End Time": "%Y-%m-%d %H:%M:%S",
+        },
     ),
     ignore_cols={
         "city",
@@ -0,0 +1,502 @@
+import asyncio
+import contextlib
+import hashlib
+import json
+import logging
+import os
+import random
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator
+from typing import Awaitable
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+from urllib.parse import urlsplit
+
+import aiohttp
+
+logger = logging.getLogger(__name__)
+
+
+USER_AGENT = (
+    "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) "
+    "AppleWebKit/537.36 (KHTML, like Gecko) Chrome/96.0.4664.55 Safari/537.36"
+)
+
+# S3 answers these when it's throttling or briefly unavailable
+RETRYABLE_STATUSES = {429, 500, 502, 503, 504}
+
+
+@dataclass(frozen=True)
+class RemoteVersion:
+    """The validators a server sent with a file, which change when the file does"""
+
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+
+    def conditional_headers(self) -> Dict[str, str]:
+        if self.etag:
+            return {"If-None-Match": self.etag}
+        elif self.last_modified:
+            return {"If-Modified-Since": self.last_modified}
+        return {}
+
+    def precondition_headers(self) -> Dict[str, str]:
+        """Headers making a request fail with 412 if the file has since changed"""
+        if self.etag:
+            return {"If-Match": self.etag}
+        elif self.last_modified:
+            return {"If-Unmodified-Since": self.last_modified}
+        return {}
+
+
+@dataclass
+class CachedFileInfo:
+    local_path: str
+    remote_path: str
+    size_bytes: Optional[int] = None
+    download_sec: Optional[float] = None  # None when served from the cache
+    downloaded_bytes: int = 0  # transferred by this run, 0 when served from the cache
+    version: Optional[RemoteVersion] = None
+    # Set when only these members of a remote zip were fetched
+    members: Optional[List[str]] = None
+
+
+@dataclass
+class DownloadConfig:
+    max_connections: int = 16
+    max_connections_per_host: int = 4
+    max_attempts: int = 5
+    backoff_base_sec: float = 1.0
+    backoff_max_sec: float = 60.0
+    max_bytes_per_sec: Optional[float] = None
+
+
+class RetryableDownloadError(Exception):
+    def __init__(self, message: str, retry_after_sec: Optional[float] = None):
+        super().__init__(message)
+        self.retry_after_sec = retry_after_sec
+
+
+class BandwidthLimiter:
+    """Token bucket shared by every download, capping total bytes per second"""
+
+    def __init__(self, bytes_per_sec: float):
+        self.bytes_per_sec = bytes_per_sec
+        self.tokens = bytes_per_sec
+        self.updated_at = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def consume(self, size: int) -> None:
+        async with self.lock:
+            now = time.monotonic()
+            self.tokens = min(
+                self.bytes_per_sec,
+                self.tokens + (now - self.updated_at) * self.bytes_per_sec,
+            )
+            self.updated_at = now
+
+            self.tokens -= size
+            if self.tokens < 0:
+                # Holding the lock while sleeping makes other downloads queue up
+                await asyncio.sleep(-self.tokens / self.bytes_per_sec)
+
+
+class DownloadScheduler:
+    """Limits shared by all downloads of a run: connections, per host slots, bandwidth"""
+
+    def __init__(self, config: DownloadConfig):
+        self.config = config
+        self.host_slots: Dict[str, asyncio.Semaphore] = {}
+        self.open_session: Optional[aiohttp.ClientSession] = None
+        self.bandwidth = (
+            BandwidthLimiter(config.max_bytes_per_sec)
+            if config.max_bytes_per_sec
+            else None
+        )
+
+    def host_slot(self, url: str) -> asyncio.Semaphore:
+        host = urlsplit(url).netloc
+        if host not in self.host_slots:
+            self.host_slots[host] = asyncio.Semaphore(
+                self.config.max_connections_per_host
+            )
+        return self.host_slots[host]
+
+    def create_session(self) -> aiohttp.ClientSession:
+        connector = aiohttp.TCPConnector(
+            limit=self.config.max_connections,
+            limit_per_host=self.config.max_connections_per_host,
+        )
+        # Large archives take longer than aiohttp's default 5 minute total timeout
+        timeout = aiohttp.ClientTimeout(total=None, sock_connect=30, sock_read=60)
+        return aiohttp.ClientSession(connector=connector, timeout=timeout)
+
+    @contextlib.asynccontextmanager
+    async def session(self) -> AsyncIterator[aiohttp.ClientSession]:
+        """A session for this scheduler, reusing the one already open if any
+
+        Opening an outer session lets several loads share one connection pool.
+        """
+        if self.open_session:
+            yield self.open_session
+            return
+
+        async with self.create_session() as session:
+            self.open_session = session
+            try:
+                yield session
+            finally:
+                self.open_session = None
+
+    def backoff_sec(self, attempt: int) -> float:
+        """Exponential backoff with full jitter, so throttled retries spread out"""
+        cap = min(
+            self.config.backoff_max_sec, self.config.backoff_base_sec * 2**attempt
+        )
+        return random.uniform(0, cap)
+
+
+@dataclass
+class PartialDownload:
+    """What the server said about a file when its .tmp download was started"""
+
+    size: int
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    content_length: Optional[int] = None
+
+    @property
+    def validator(self) -> Optional[str]:
+        # Weak ETags can't be used with If-Range
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+
+
+def partial_meta_path(tmp_local_path: str) -> str:
+    return tmp_local_path + ".json"
+
+
+def read_partial_download(tmp_local_path: str) -> Optional[PartialDownload]:
+    meta_path = partial_meta_path(tmp_local_path)
+    if not os.path.exists(tmp_local_path) or not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path) as f:
+        meta = json.load(f)
+    return PartialDownload(size=os.path.getsize(tmp_local_path), **meta)
+
+
+def write_partial_meta(tmp_local_path: str, partial: PartialDownload) -> None:
+    with open(partial_meta_path(tmp_local_path), "w") as f:
+        json.dump(
+            {
+                "etag": partial.etag,
+                "last_modified": partial.last_modified,
+                "content_length": partial.content_length,
+            },
+            f,
+        )
+
+
+def discard_partial_download(tmp_local_path: str) -> None:
+    for path in (tmp_local_path, partial_meta_path(tmp_local_path)):
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def parse_content_range(value: str) -> Tuple[Optional[int], Optional[int]]:
+    """The first byte and total size of a "bytes 100-199/200" header"""
+    try:
+        _, _, spec = value.partition(" ")
+        byte_range, _, total = spec.partition("/")
+        start = int(byte_range.split("-")[0]) if byte_range != "*" else None
+        return start, int(total) if total != "*" else None
+    except ValueError:
+        return None, None
+
+
+def md5_etag_matches(path: str, etag: Optional[str]) -> bool:
+    """Check a file against an S3 style ETag, which is the MD5 of single part uploads
+
+    Multipart ETags ("<md5>-<parts>") and other formats can't be checked and pass.
+    """
+    digest = (etag or "").strip('"')
+    if len(digest) != 32 or not all(c in "0123456789abcdef" for c in digest.lower()):
+        return True
+
+    md5 = hashlib.md5()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(2**20), b""):
+            md5.update(block)
+    return md5.hexdigest() == digest.lower()
+
+
+def version_path(local_path: str) -> str:
+    return local_path + ".json"
+
+
+def read_remote_version(local_path: str) -> Optional[RemoteVersion]:
+    """The version of a cached file, None if it was downloaded without validators"""
+    path = version_path(local_path)
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        meta = json.load(f)
+    version = RemoteVersion(etag=meta["etag"], last_modified=meta["last_modified"])
+    return version if version.conditional_headers() else None
+
+
+def write_remote_version(local_path: str, version: RemoteVersion) -> None:
+    with open(version_path(local_path), "w") as f:
+        json.dump({"etag": version.etag, "last_modified": version.last_modified}, f)
+
+
+async def adopt_remote_version(
+    session: aiohttp.ClientSession, url: str, cached_file_info: CachedFileInfo
+) -> bool:
+    """Record the version of a file cached without one, if it's still current
+
+    The validators come from a HEAD request. The cached file only takes them if
+    it has the size, and for S3 style ETags the MD5, of the remote one. Returns
+    whether it's current, True when the server can't tell.
+    """
+    headers = {"User-Agent": USER_AGENT}
+    async with session.head(url, headers=headers, allow_redirects=True) as resp:
+        if resp.status in RETRYABLE_STATUSES:
+            raise RetryableDownloadError(f"HEAD status {resp.status} for {url}")
+        if not (resp.status >= 200 and resp.status < 300):
+            logger.warning(f"Can't revalidate {url}, HEAD status {resp.status}")
+            return True
+        version = RemoteVersion(
+            etag=resp.headers.get("ETag"),
+            last_modified=resp.headers.get("Last-Modified"),
+        )
+        content_length = resp.content_length
+
+    local_path = cached_file_info.local_path
+    if content_length is not None and content_length != os.path.getsize(local_path):
+        return False
+    elif not await asyncio.to_thread(md5_etag_matches, local_path, version.etag):
+        return False
+
+    if version.conditional_headers():
+        await asyncio.to_thread(write_remote_version, local_path, version)
+        cached_file_info.version = version
+    return True
+
+
+def file_path_for_url(url: str, data_dir_path: str) -> str:
+    url_hash = hashlib.sha256()
+    url_hash.update(url.encode("utf-8"))
+    return os.path.join(data_dir_path, url_hash.hexdigest())
+
+
+async def async_download_urls(
+    data_dir_path: str,
+    urls: Iterable[str],
+    config: Optional[DownloadConfig] = None,
+    revalidate: bool = False,
+    scheduler: Optional[DownloadScheduler] = None,
+) -> List[CachedFileInfo]:
+    logger.debug(f"working dir: {data_dir_path}")
+    scheduler = scheduler or DownloadScheduler(config or DownloadConfig())
+    async with scheduler.session() as session:
+        return await asyncio.gather(
+            *[
+                download_url_with_retry(
+                    data_dir_path=data_dir_path,
+                    session=session,
+                    url=url,
+                    scheduler=scheduler,
+                    revalidate=revalidate,
+                )
+                for url in urls
+            ]
+        )
+
+
+async def download_url(
+    data_dir_path: str,
+    session: aiohttp.ClientSession,
+    url: str,
+    scheduler: Optional[DownloadScheduler] = None,
+    revalidate: bool = False,
+) -> CachedFileInfo:
+    """Download url into data_dir_path unless it's already cached there
+
+    With revalidate, cached files are checked with a conditional request and
+    downloaded again if the server has a newer version. Files cached without a
+    version are given the server's if they're still current. Hashing and
+    sidecar files run in threads, so large archives don't stall other downloads.
+    """
+    local_path = file_path_for_url(url=url, data_dir_path=data_dir_path)
+    cached_file_info = CachedFileInfo(
+        local_path=local_path,
+        remote_path=url,
+        version=await asyncio.to_thread(read_remote_version, local_path),
+    )
+    cached = os.path.exists(local_path)
+    if cached and revalidate and not cached_file_info.version:
+        if await adopt_remote_version(session, url, cached_file_info):
+            logger.debug(f"File {url} cached at {local_path} is current")
+            cached_file_info.size_bytes = os.path.getsize(local_path)
+            return cached_file_info
+        logger.info(f"File {url} changed since it was cached at {local_path}")
+        cached = False
+    if cached and not (revalidate and cached_file_info.version):
+        logger.debug(f"File {url} cached at {local_path}")
+        cached_file_info.size_bytes = os.path.getsize(local_path)
+        return cached_file_info
+
+    tmp_local_path = local_path + ".tmp"
+    # Metro Bike Share 403's without a user agent...
+    headers = {"User-Agent": USER_AGENT}
+    if cached and cached_file_info.version:
+        headers.update(cached_file_info.version.conditional_headers())
+
+    # Continue an interrupted download, unless we can't tell whether it changed
+    partial = await asyncio.to_thread(read_partial_download, tmp_local_path)
+    if cached:
+        partial = None
+    elif partial and partial.size > 0 and partial.validator:
+        headers["Range"] = f"bytes={partial.size}-"
+        headers["If-Range"] = partial.validator
+    else:
+        partial = None
+
+    async with session.get(url, headers=headers) as resp:
+        if resp.status == 304:
+            logger.debug(f"File {url} unchanged since it was cached at {local_path}")
+            cached_file_info.size_bytes = os.path.getsize(local_path)
+            return cached_file_info
+        if resp.status in RETRYABLE_STATUSES:
+            retry_after = resp.headers.get("Retry-After", "")
+            raise RetryableDownloadError(
+                f"Download status {resp.status} for {url}",
+                retry_after_sec=float(retry_after) if retry_after.isdigit() else None,
+            )
+        if resp.status == 416 and partial:
+            discard_partial_download(tmp_local_path)
+            raise RetryableDownloadError(f"Partial download of {url} is unusable")
+        if not (resp.status >= 200 and resp.status < 300):
+            logger.warn(
+                f"Unexpected download status {resp.status} for {url}: {await resp.text()}"
+            )
+            return cached_file_info  # TODO: This should be an exception
+
+        if resp.status == 206 and partial:
+            start, total = parse_content_range(resp.headers.get("Content-Range", ""))
+            if start != partial.size or total != partial.content_length:
+                discard_partial_download(tmp_local_path)
+                raise RetryableDownloadError(
+                    f"Server returned bytes from {start} of {total} for {url}, "
+                    f"expected {partial.size} of {partial.content_length}"
+                )
+            logger.info(f"Resuming download: {url} from byte {partial.size}")
+            mode = "ab"
+        else:
+            # A 200 means the server ignored the range or the file changed
+            partial = PartialDownload(
+                size=0,
+                etag=resp.headers.get("ETag"),
+                last_modified=resp.headers.get("Last-Modified"),
+                content_length=resp.content_length,
+            )
+            await asyncio.to_thread(write_partial_meta, tmp_local_path, partial)
+            mode = "wb"
+
+        started_at = time.monotonic()
+        size_bytes = 0
+        with open(tmp_local_path, mode) as fd:
+            logger.info(f"Started downloading: {url} to {local_path}")
+            while True:
+                chunk = await resp.content.read(2**16)
+                if not chunk:
+                    break
+                if scheduler and scheduler.bandwidth:
+                    await scheduler.bandwidth.consume(len(chunk))
+                fd.write(chunk)
+                size_bytes += len(chunk)
+
+    final_size = os.path.getsize(tmp_local_path)
+    if partial.content_length is not None and final_size != partial.content_length:
+        if final_size > partial.content_length:
+            discard_partial_download(tmp_local_path)
+        raise RetryableDownloadError(
+            f"Downloaded {final_size} bytes of {url}, expected {partial.content_length}"
+        )
+    if not await asyncio.to_thread(md5_etag_matches, tmp_local_path, partial.etag):
+        discard_partial_download(tmp_local_path)
+        raise RetryableDownloadError(f"Downloaded {url} doesn't match its ETag")
+
+    os.replace(tmp_local_path, local_path)
+    # Keep the validators so the cached file can be revalidated later
+    os.replace(partial_meta_path(tmp_local_path), version_path(local_path))
+    cached_file_info.version = RemoteVersion(
+        etag=partial.etag, last_modified=partial.last_modified
+    )
+    cached_file_info.size_bytes = final_size
+    cached_file_info.download_sec = time.monotonic() - started_at
+    cached_file_info.downloaded_bytes = size_bytes
+    logger.info(
+        f"Finished downloading: {url} ({size_bytes / 2**20:.1f} MiB in "
+        f"{cached_file_info.download_sec:.1f}s, "
+        f"{size_bytes / 2**20 / max(cached_file_info.download_sec, 1e-6):.2f} MiB/s)"
+    )
+    return cached_file_info
+
+
+async def retry_download(
+    url: str,
+    download: Callable[[], Awaitable[CachedFileInfo]],
+    scheduler: DownloadScheduler,
+    max_attempts: Optional[int] = None,
+) -> CachedFileInfo:
+    """Retry a download with exponential backoff, holding a per host slot each try"""
+    max_attempts = max_attempts or scheduler.config.max_attempts
+    for i in range(max_attempts):
+        try:
+            async with scheduler.host_slot(url):
+                return await download()
+        except Exception as e:
+            logger.exception(f"Failed to download {url} on attempt {i+1}")
+            if i + 1 == max_attempts:
+                break
+
+            delay_sec = scheduler.backoff_sec(i)
+            if isinstance(e, RetryableDownloadError) and e.retry_after_sec:
+                delay_sec = max(delay_sec, e.retry_after_sec)
+            logger.info(f"Retrying {url} in {delay_sec:.1f}s")
+            await asyncio.sleep(delay_sec)
+
+    raise Exception(f"Failed to download {url} after {max_attempts} attempts")
+
+
+async def download_url_with_retry(
+    data_dir_path: str,
+    session: aiohttp.ClientSession,
+    url: str,
+    max_attempts: Optional[int] = None,
+    scheduler: Optional[DownloadScheduler] = None,
+    revalidate: bool = False,
+) -> CachedFileInfo:
+    scheduler = scheduler or DownloadScheduler(DownloadConfig())
+    return await retry_download(
+        url,
+        lambda: download_url(
+            data_dir_path=data_dir_path,
+            session=session,
+            url=url,
+            scheduler=scheduler,
+            revalidate=revalidate,
+        ),
+        scheduler=scheduler,
+        max_attempts=max_attempts,
+    )
@@ -0,0 +1,205 @@
+"""Wall time, rows, bytes and memory of each stage of a load
+
+A StageRecorder is passed down the load and every stage it reaches records a
+StageMetrics, per archive or CSV where the stage works on one. CSVs may be
+parsed in worker processes, which record into a fork of the recorder and send
+their metrics back with their results.
+
+One stage can also be run under cProfile. Each run of it is dumped separately,
+workers included, and the dumps are merged into a single file by save_profile.
+Runs overlapping one already profiled, like concurrent downloads, are only
+timed, since a thread has one profiler at a time.
+"""
+import contextlib
+import cProfile
+import json
+import os
+import pstats
+import shutil
+import tempfile
+import time
+from dataclasses import asdict
+from dataclasses import dataclass
+from typing import Any
+from typing import Callable
+from typing import ContextManager
+from typing import Dict
+from typing import Iterator
+from typing import List
+from typing import Optional
+
+from opendata.sources.bikeshare.budget import current_rss_bytes
+from opendata.sources.bikeshare.budget import peak_rss_bytes
+
+STAGES = [
+    "list_urls",  # listing the market's archives
+    "download",  # fetching an archive, or finding it cached
+    "read_cache",  # loading a CSV parsed by an earlier run
+    "read_csv",  # sampling and parsing a CSV
+    "merge_columns",  # mapping a CSV's columns to the standard ones
+    "parse_datetimes",  # parsing one datetime column of a CSV
+    "remap_values",  # remapping the values of one column of a CSV
+    "concat",  # concatenating the parsed CSVs
+    "parse_datetime_columns",  # parsing datetimes left as text
+    "merge_stations_table",  # filling trips from the station table
+]
+
+
+@dataclass
+class StageMetrics:
+    stage: str
+    archive: Optional[str] = None  # remote path
+    member: Optional[str] = None  # CSV inside the archive
+    elapsed_sec: float = 0.0
+    rows_in: Optional[int] = None
+    rows_out: Optional[int] = None
+    bytes_read: Optional[int] = None
+    # Of the process that ran the stage, when it ended
+    rss_bytes: Optional[int] = None
+    peak_rss_bytes: Optional[int] = None
+
+
+class StageRecorder:
+    """Collect the metrics of each stage, passing them to on_stage as they come
+
+    on_stage only runs in the process that created the recorder, for worker
+    metrics once they're sent back.
+    """
+
+    def __init__(
+        self,
+        on_stage: Optional[Callable[[StageMetrics], None]] = None,
+        profile_stage: Optional[str] = None,
+        profile_path: Optional[str] = None,
+        fields: Optional[Dict[str, Any]] = None,
+    ):
+        if profile_stage is not None and profile_stage not in STAGES:
+            raise ValueError(f"Unknown stage {profile_stage}, expected one of {STAGES}")
+        elif (profile_stage is None) != (profile_path is None):
+            raise ValueError("Profiling needs both a stage and a path")
+
+        self.on_stage = on_stage
+        self.profile_stage = profile_stage
+        self.profile_path = profile_path
+        self.fields = fields or {}  # recorded with every stage, e.g. the archive
+        self.stages: List[StageMetrics] = []
+        self.profiling = False
+
+    def fork(self, **fields: Any) -> "StageRecorder":
+        """An empty recorder with the same profiling, safe to send to workers
+
+        Its stages are recorded with fields, on top of this recorder's.
+        """
+        return StageRecorder(
+            profile_stage=self.profile_stage,
+            profile_path=self.profile_path,
+            fields={**self.fields, **fields},
+        )
+
+    def add(self, metrics: StageMetrics) -> None:
+        self.stages.append(metrics)
+        if self.on_stage:
+            self.on_stage(metrics)
+
+    def extend(self, stages: List[StageMetrics]) -> None:
+        for metrics in stages:
+            self.add(metrics)
+
+    @contextlib.contextmanager
+    def stage(self, name: str, **fields: Any) -> Iterator[StageMetrics]:
+        """Time the body as stage name, which may fill in the yielded metrics"""
+        metrics = StageMetrics(stage=name, **{**self.fields, **fields})
+        profiler = None
+        if name == self.profile_stage and not self.profiling:
+            profiler = cProfile.Profile()
+            self.profiling = True
+        started_at = time.perf_counter()
+        if profiler:
+            profiler.enable()
+        try:
+            yield metrics
+        finally:
+            if profiler:
+                profiler.disable()
+                self.profiling = False
+                self.dump_profile(profiler)
+            metrics.elapsed_sec = time.perf_counter() - started_at
+            metrics.rss_bytes = current_rss_bytes()
+            metrics.peak_rss_bytes = peak_rss_bytes()
+            self.add(metrics)
+
+    @property
+    def profile_parts_dir(self) -> str:
+        assert self.profile_path
+        return self.profile_path + ".parts"
+
+    def dump_profile(self, profiler: cProfile.Profile) -> None:
+        os.makedirs(self.profile_parts_dir, exist_ok=True)
+        fd, path = tempfile.mkstemp(dir=self.profile_parts_dir, suffix=".prof")
+        os.close(fd)
+        profiler.dump_stats(path)
+
+    def save_profile(self) -> Optional[str]:
+        """Merge the profiled runs of the stage into profile_path, if it ran"""
+        if not self.profile_path or not os.path.isdir(self.profile_parts_dir):
+            return None
+
+        parts = sorted(
+            os.path.join(self.profile_parts_dir, name)
+            for name in os.listdir(self.profile_parts_dir)
+        )
+        if parts:
+            pstats.Stats(*parts).dump_stats(self.profile_path)
+        shutil.rmtree(self.profile_parts_dir)
+        return self.profile_path if parts else None
+
+    def summary(self) -> List[Dict[str, Any]]:
+        """Totals per stage in STAGES order, the highest peak RSS of each"""
+        totals: Dict[str, Dict[str, Any]] = {}
+        for metrics in self.stages:
+            total = totals.setdefault(
+                metrics.stage,
+                {
+                    "stage": metrics.stage,
+                    "runs": 0,
+                    "elapsed_sec": 0.0,
+                    "rows_in": 0,
+                    "rows_out": 0,
+                    "bytes_read": 0,
+                    "peak_rss_bytes": 0,
+                },
+            )
+            total["runs"] += 1
+            total["elapsed_sec"] += metrics.elapsed_sec
+            total["rows_in"] += metrics.rows_in or 0
+            total["rows_out"] += metrics.rows_out or 0
+            total["bytes_read"] += metrics.bytes_read or 0
+            total["peak_rss_bytes"] = max(
+                total["peak_rss_bytes"], metrics.peak_rss_bytes or 0
+            )
+        return sorted(
+            totals.values(),
+            key=lambda total: STAGES.index(total["stage"])
+            if total["stage"] in STAGES
+            else len(STAGES),
+        )
+
+    def report(self) -> Dict[str, Any]:
+        return {
+            "summary": self.summary(),
+            "stages": [asdict(metrics) for metrics in self.stages],
+        }
+
+    def write_report(self, path: str) -> None:
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w") as f:
+            json.dump(self.report(), f, indent=2)
+
+
+def record_stage(
+    recorder: Optional[StageRecorder], name: str, **fields: Any
+) -> ContextManager[StageMetrics]:
+    """recorder.stage, or metrics that go nowhere without a recorder"""
+    if recorder is None:
+        return contextlib.nullcontext(StageMetrics(stage=name, **fields))
+    return recorder.stage(name, **fields)
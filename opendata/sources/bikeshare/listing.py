@@ -0,0 +1,209 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import time
+from html.parser import HTMLParser
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Pattern
+from typing import Tuple
+from urllib.parse import quote
+from urllib.parse import urljoin
+from urllib.parse import urlsplit
+from xml.etree import ElementTree
+
+import aiohttp
+
+from opendata.sources.bikeshare.downloads import DownloadConfig
+from opendata.sources.bikeshare.downloads import DownloadScheduler
+
+logger = logging.getLogger(__name__)
+
+# Data pages change about once a month, a day old listing is fine
+DEFAULT_LISTING_TTL_SEC = 24 * 60 * 60
+
+
+class HrefParser(HTMLParser):
+    """Collect the href of every anchor in a static HTML page"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.hrefs: List[str] = []
+
+    def handle_starttag(self, tag: str, attrs: List[Tuple[str, Optional[str]]]) -> None:
+        if tag != "a":
+            return
+
+        for name, value in attrs:
+            if name == "href" and value:
+                self.hrefs.append(value)
+
+
+def listing_base_url(url: str) -> Optional[str]:
+    """The bucket root for S3 style index.html pages, None for any other page"""
+    path = urlsplit(url).path
+    if path.endswith("/index.html") or path.endswith("/") or not path:
+        return url[: url.rfind("/") + 1] if path else url + "/"
+    return None
+
+
+async def list_s3_keys(
+    session: aiohttp.ClientSession,
+    base_url: str,
+    headers: Dict[str, str],
+    timeout: Optional[aiohttp.ClientTimeout] = None,
+) -> Optional[List[str]]:
+    """Page through a bucket's ListObjectsV2 XML, None if it isn't an S3 bucket"""
+    keys: List[str] = []
+    params = {"list-type": "2"}
+    while True:
+        async with session.get(
+            base_url, params=params, headers=headers, timeout=timeout
+        ) as resp:
+            if resp.status != 200:
+                return None
+            body = await resp.text()
+
+        try:
+            root = ElementTree.fromstring(body)
+        except ElementTree.ParseError:
+            return None
+        if not root.tag.endswith("ListBucketResult"):
+            return None
+
+        keys.extend(key.text for key in root.iterfind("{*}Contents/{*}Key") if key.text)
+        token = root.findtext("{*}NextContinuationToken")
+        if root.findtext("{*}IsTruncated") != "true" or not token:
+            return keys
+
+        logger.debug(f"Listing {base_url} continues after {len(keys)} keys")
+        params = {"list-type": "2", "continuation-token": token}
+
+
+async def async_list_hrefs(
+    session: aiohttp.ClientSession, url: str, timeout_sec: int, headers: Dict[str, str]
+) -> List[str]:
+    """Absolute hrefs of a listing page, read from S3 XML or from static HTML"""
+    timeout = aiohttp.ClientTimeout(total=timeout_sec)
+    base_url = listing_base_url(url)
+    if base_url:
+        keys = await list_s3_keys(session, base_url, headers, timeout=timeout)
+        if keys is not None:
+            return [urljoin(base_url, quote(key)) for key in keys]
+
+    async with session.get(url, headers=headers, timeout=timeout) as resp:
+        resp.raise_for_status()
+        page = await resp.text()
+
+    parser = HrefParser()
+    parser.feed(page)
+    return [urljoin(url, href) for href in parser.hrefs]
+
+
+def extract_hrefs_with_selenium(url: str, timeout_sec: int) -> List[str]:
+    """Render a JavaScript page in headless Chrome and collect its hrefs"""
+    try:
+        from selenium import webdriver
+        from selenium.common.exceptions import TimeoutException
+        from selenium.webdriver.common.by import By
+        from selenium.webdriver.support import expected_conditions as EC
+        from selenium.webdriver.support.ui import WebDriverWait
+    except ImportError:
+        logger.warning(f"Selenium is not installed, can't render {url}")
+        return []
+
+    options = webdriver.ChromeOptions()
+    options.add_argument("headless")
+    browser = webdriver.Chrome(options=options)
+    try:
+        browser.get(url)
+
+        try:
+            WebDriverWait(browser, timeout_sec).until(
+                EC.presence_of_element_located((By.TAG_NAME, "a"))
+            )
+        except TimeoutException:
+            logger.debug(f"Loading {url} timed out...")
+
+        logger.debug(f"Page {url} loaded!")
+
+        hrefs = []
+        for a_element in browser.find_elements(By.TAG_NAME, "a"):
+            href = a_element.get_attribute("href")
+            if href:
+                hrefs.append(href)
+        return hrefs
+    finally:
+        browser.quit()
+
+
+def listing_cache_path(cache_dir: str, url: str) -> str:
+    url_hash = hashlib.sha256()
+    url_hash.update(url.encode("utf-8"))
+    return os.path.join(cache_dir, f"{url_hash.hexdigest()}.json")
+
+
+def read_cached_listing(path: str, ttl_sec: float) -> Optional[List[str]]:
+    if not os.path.exists(path):
+        return None
+
+    with open(path) as f:
+        cached = json.load(f)
+    if time.time() - cached["fetched_at"] > ttl_sec:
+        return None
+    return cached["hrefs"]
+
+
+def write_cached_listing(path: str, hrefs: List[str]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump({"fetched_at": time.time(), "hrefs": hrefs}, f)
+    os.replace(tmp_path, path)
+
+
+async def async_extract_hrefs_from_url(
+    url: str,
+    href_pattern: Pattern,
+    timeout_sec: int,
+    headers: Dict[str, str],
+    cache_dir: Optional[str] = None,
+    ttl_sec: float = DEFAULT_LISTING_TTL_SEC,
+    scheduler: Optional[DownloadScheduler] = None,
+) -> List[str]:
+    """Find the download links on a data page, falling back to Selenium
+
+    Selenium renders the page when plain HTTP finds no links or is refused.
+    Listings are cached in cache_dir for ttl_sec so reruns skip the network.
+    Pages are fetched within the connection and per host limits of scheduler.
+    """
+    cache_path = listing_cache_path(cache_dir, url) if cache_dir else None
+    hrefs = read_cached_listing(cache_path, ttl_sec) if cache_path else None
+    if hrefs is not None:
+        logger.debug(f"Listing of {url} cached at {cache_path}")
+    else:
+        scheduler = scheduler or DownloadScheduler(DownloadConfig())
+        try:
+            async with scheduler.session() as session, scheduler.host_slot(url):
+                hrefs = await async_list_hrefs(
+                    session, url, timeout_sec=timeout_sec, headers=headers
+                )
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            # Bot walls refuse plain HTTP clients but may let a browser through
+            logger.warning(f"Failed to fetch {url}: {e}")
+            hrefs = []
+        if not any(href_pattern.match(href) for href in hrefs):
+            logger.info(f"No links found in {url}, rendering it with Selenium")
+            hrefs = await asyncio.to_thread(
+                extract_hrefs_with_selenium, url, timeout_sec
+            )
+        if cache_path and hrefs:
+            write_cached_listing(cache_path, hrefs)
+
+    matched = [href for href in hrefs if href_pattern.match(href)]
+    for href in matched:
+        logger.debug(f"Found download at path {href}")
+    return matched
@@ -0,0 +1,52 @@
+from dataclasses import dataclass
+from typing import Optional
+
+from opendata.sources.bikeshare.csv_readers import CsvEngine
+from opendata.sources.bikeshare.downloads import DownloadConfig
+from opendata.sources.bikeshare.downloads import DownloadScheduler
+from opendata.sources.bikeshare.listing import DEFAULT_LISTING_TTL_SEC
+from opendata.sources.bikeshare.periods import DateRange
+from opendata.sources.bikeshare.sample_targets import SampleTarget
+from opendata.sources.bikeshare.sampling import SampleConfig
+from opendata.sources.bikeshare.sampling import SampleMethod
+
+
+@dataclass
+class LoadOptions:
+    """How the loaders of a bikeshare data source list, fetch, sample and parse
+
+    Chunked loads don't use the parsed cache or a memory budget, and loads of
+    changed archives take every archive whole, without a date range or target.
+    """
+
+    sample_rate: int = 1
+    sample_method: SampleMethod = SampleMethod.SYSTEMATIC
+    sample_seed: Optional[int] = None
+    sample_size: Optional[int] = None  # rows kept per file by reservoir sampling
+    sample_target: Optional[SampleTarget] = None
+    memory_budget_bytes: Optional[int] = None
+    date_range: Optional[DateRange] = None
+    compact: bool = False
+    engine: CsvEngine = CsvEngine.PANDAS
+    workers: int = 1
+    parsed_cache: bool = True
+    listing_ttl_sec: float = DEFAULT_LISTING_TTL_SEC
+    download_config: Optional[DownloadConfig] = None
+    remote_zip: bool = False
+
+    def __post_init__(self) -> None:
+        if self.memory_budget_bytes is not None and self.sample_target is not None:
+            raise ValueError("A sample target can't be combined with a memory budget")
+
+    def sample_config(self) -> SampleConfig:
+        """The sample of every trip CSV, before any budget or target adjusts it"""
+        return SampleConfig(
+            rate=self.sample_rate,
+            method=self.sample_method,
+            seed=self.sample_seed,
+            size=self.sample_size,
+        )
+
+    def download_scheduler(self) -> DownloadScheduler:
+        """A scheduler for a load of its own, not sharing downloads with others"""
+        return DownloadScheduler(self.download_config or DownloadConfig())
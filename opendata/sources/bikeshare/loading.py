@@ -0,0 +1,491 @@
+"""Download archives and parse their CSVs into trips and stations
+
+Full loads parse every member in an executor as its archive lands, chunked
+loads stream the trips of each CSV, and loads of changed archives parse one
+archive at a time.
+"""
+import asyncio
+import collections
+import contextlib
+import functools
+import logging
+from concurrent.futures import Executor
+from concurrent.futures import Future
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable
+from typing import Deque
+from typing import Dict
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+
+import aiohttp
+import pandas as pd
+
+from opendata.sources.bikeshare.catalog import SchemaCatalog
+from opendata.sources.bikeshare.columns import concat_frames
+from opendata.sources.bikeshare.columns import merge_columns
+from opendata.sources.bikeshare.csv_readers import CsvEngine
+from opendata.sources.bikeshare.csv_readers import iter_csv_chunks
+from opendata.sources.bikeshare.csv_readers import read_csv
+from opendata.sources.bikeshare.downloads import CachedFileInfo
+from opendata.sources.bikeshare.downloads import download_url_with_retry
+from opendata.sources.bikeshare.downloads import DownloadConfig
+from opendata.sources.bikeshare.downloads import DownloadScheduler
+from opendata.sources.bikeshare.downloads import RemoteVersion
+from opendata.sources.bikeshare.instrumentation import record_stage
+from opendata.sources.bikeshare.instrumentation import StageMetrics
+from opendata.sources.bikeshare.instrumentation import StageRecorder
+from opendata.sources.bikeshare.members import catalog_member
+from opendata.sources.bikeshare.members import catalog_results
+from opendata.sources.bikeshare.members import catalog_rows
+from opendata.sources.bikeshare.members import csv_rows
+from opendata.sources.bikeshare.members import filter_trips
+from opendata.sources.bikeshare.members import iter_csv_members
+from opendata.sources.bikeshare.members import list_member_tasks
+from opendata.sources.bikeshare.members import MemberResult
+from opendata.sources.bikeshare.members import MemberTask
+from opendata.sources.bikeshare.members import parse_member
+from opendata.sources.bikeshare.members import wants_member
+from opendata.sources.bikeshare.parsers import ColumnParser
+from opendata.sources.bikeshare.parsers import determine_filetype
+from opendata.sources.bikeshare.parsers import dtype_mapping
+from opendata.sources.bikeshare.parsers import FileType
+from opendata.sources.bikeshare.parsers import get_columns_parsed
+from opendata.sources.bikeshare.parsers import log_csv_column_results
+from opendata.sources.bikeshare.parsers import project_columns
+from opendata.sources.bikeshare.periods import DateRange
+from opendata.sources.bikeshare.remote_zip import download_zip_members_with_retry
+from opendata.sources.bikeshare.sampling import open_sampled_csv
+from opendata.sources.bikeshare.sampling import RowCount
+from opendata.sources.bikeshare.sampling import SampleConfig
+
+logger = logging.getLogger(__name__)
+
+# Rows per chunk when streaming trips, small enough to keep memory flat
+DEFAULT_CHUNKSIZE = 500_000
+
+
+def open_and_concat_paths(
+    cached_files: List[CachedFileInfo],
+    trip_sample: SampleConfig,
+    trip_parsers: List[ColumnParser],
+    ignore_cols: Set[str],
+    station_parsers: Optional[List[ColumnParser]] = None,
+    raw_data: bool = False,
+    workers: int = 1,
+    cache_dir: Optional[str] = None,
+    compact: bool = False,
+    date_range: Optional[DateRange] = None,
+    catalog: Optional[SchemaCatalog] = None,
+    engine: CsvEngine = CsvEngine.PANDAS,
+    recorder: Optional[StageRecorder] = None,
+    executor: Optional[Executor] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Open a list of locally cached files and concatenate into a single CSV
+
+    Unless raw_data is set, each file is mapped to the standard columns before
+    concatenation, so the result never carries the union of every era's headers.
+    The CSVs are parsed in executor, or with more than one worker in a process
+    pool of their own. Results are gathered in task order, so the output doesn't
+    depend on the worker count.
+    """
+    tasks = list_member_tasks(cached_files, date_range, catalog)
+    parse = functools.partial(
+        parse_member,
+        trip_sample=trip_sample,
+        trip_parsers=trip_parsers,
+        station_parsers=station_parsers,
+        raw_data=raw_data,
+        cache_dir=cache_dir,
+        compact=compact,
+        date_range=date_range,
+        engine=engine,
+        recorder=recorder.fork() if recorder else None,
+    )
+
+    with contextlib.ExitStack() as stack:
+        if executor is None and workers > 1:
+            executor = stack.enter_context(parse_executor(workers))
+        results: Iterable[Optional[MemberResult]] = (
+            executor.map(parse, tasks) if executor else map(parse, tasks)
+        )
+
+        trips_result, stations_result = concat_member_results(
+            catalog_results(catalog, tasks, results),
+            trip_parsers=trip_parsers,
+            station_parsers=station_parsers,
+            ignore_cols=ignore_cols,
+            recorder=recorder,
+        )
+
+    if catalog:
+        catalog.save()
+    return trips_result, stations_result
+
+
+def concat_member_results(
+    results: Iterable[Optional[MemberResult]],
+    trip_parsers: List[ColumnParser],
+    station_parsers: Optional[List[ColumnParser]],
+    ignore_cols: Set[str],
+    recorder: Optional[StageRecorder] = None,
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Concatenate parsed CSVs into the trips and stations frames
+
+    The stages each CSV recorded while being parsed are added to recorder.
+    """
+    trip_dfs: List[pd.DataFrame] = [pd.DataFrame()]
+    station_dfs: List[pd.DataFrame] = [pd.DataFrame()]
+    trip_columns_found: Set[str] = set()
+    station_columns_found: Set[str] = set()
+
+    for result in results:
+        if result is None:
+            continue
+
+        if recorder:
+            recorder.extend(result.metrics)
+        if result.filetype == FileType.TRIPS:
+            trip_columns_found.update(result.header)
+            trip_dfs.append(result.df)
+        elif result.filetype == FileType.STATIONS:
+            station_columns_found.update(result.header)
+            station_dfs.append(result.df)
+
+    with record_stage(
+        recorder, "concat", rows_in=sum(len(df) for df in trip_dfs)
+    ) as metrics:
+        trips_result = concat_frames(trip_dfs)
+        metrics.rows_out = len(trips_result)
+    log_csv_column_results(
+        trip_columns_found, trip_parsers, ignore_cols, log_label="Trips"
+    )
+
+    stations_result = concat_frames(station_dfs)
+    if station_parsers:
+        log_csv_column_results(
+            station_columns_found, station_parsers, ignore_cols, log_label="Stations"
+        )
+
+    return trips_result, stations_result
+
+
+def open_and_concat_stations(
+    cached_files: List[CachedFileInfo],
+    trip_parsers: List[ColumnParser],
+    station_parsers: List[ColumnParser],
+    ignore_cols: Set[str],
+    catalog: Optional[SchemaCatalog] = None,
+    engine: CsvEngine = CsvEngine.PANDAS,
+) -> pd.DataFrame:
+    """Load only the station CSVs, which are small enough to keep in memory"""
+    station_dfs: List[pd.DataFrame] = [pd.DataFrame()]
+    station_parse_config = dtype_mapping(station_parsers)
+
+    trip_cols = get_columns_parsed(trip_parsers)
+    station_cols = get_columns_parsed(station_parsers)
+    columns_found: Set[str] = set()
+
+    for cached_file_info in cached_files:
+        try:
+            for name, size_bytes, f in iter_csv_members(cached_file_info):
+                schema = catalog_member(
+                    catalog,
+                    cached_file_info,
+                    name,
+                    size_bytes,
+                    f,
+                    trip_cols,
+                    station_cols,
+                )
+                header = schema.header
+                filetype = determine_filetype(
+                    trip_cols=trip_cols,
+                    station_cols=station_cols,
+                    header=header,
+                )
+                if filetype == FileType.STATIONS:
+                    columns_found.update(header)
+                    station_df = read_csv(
+                        f,
+                        engine=engine,
+                        dtypes=station_parse_config.dtypes,
+                        usecols=project_columns(header, station_parsers),
+                    )
+                    catalog_rows(
+                        catalog, cached_file_info, name, schema, len(station_df)
+                    )
+                    station_dfs.append(merge_columns(station_parsers, station_df))
+        except Exception:
+            logger.exception(
+                f"Failed to open cached file {cached_file_info.local_path} from {cached_file_info.remote_path}"
+            )
+            continue
+
+    if catalog:
+        catalog.save()
+    log_csv_column_results(
+        columns_found, station_parsers, ignore_cols, log_label="Stations"
+    )
+    return pd.concat(station_dfs)
+
+
+def merge_trip_chunk(
+    trip_parsers: List[ColumnParser],
+    chunk: pd.DataFrame,
+    guessed_formats: Dict[str, Optional[str]],
+    compact: bool = False,
+    date_range: Optional[DateRange] = None,
+    recorder: Optional[StageRecorder] = None,
+) -> Tuple[pd.DataFrame, Dict[str, Optional[str]], List[StageMetrics]]:
+    """Map a chunk of trips to the standard columns, keeping those in date_range
+
+    The guessed formats and stages of the chunk are returned with its trips, as a
+    worker process can't update them in place.
+    """
+    stages = recorder.fork() if recorder else None
+    merged = merge_columns(
+        trip_parsers,
+        chunk,
+        compact=compact,
+        guessed_formats=guessed_formats,
+        recorder=stages,
+    )
+    return (
+        filter_trips(merged, date_range),
+        guessed_formats,
+        stages.stages if stages else [],
+    )
+
+
+MergeChunk = Callable[
+    [pd.DataFrame, Dict[str, Optional[str]]],
+    Tuple[pd.DataFrame, Dict[str, Optional[str]], List[StageMetrics]],
+]
+
+
+def merge_trip_chunks(
+    chunks: Iterable[pd.DataFrame],
+    merge: MergeChunk,
+    executor: Optional[Executor] = None,
+    window: int = 1,
+) -> Iterator[Tuple[int, pd.DataFrame, List[StageMetrics]]]:
+    """Merge the chunks of one CSV in order, up to window of them at once in executor
+
+    Yields the rows read, trips and stages of each chunk. The first chunk is merged
+    alone, so the others share the datetime formats guessed from it.
+    """
+    guessed_formats: Dict[str, Optional[str]] = {}
+    if executor is None:
+        for chunk in chunks:
+            trips, guessed_formats, stages = merge(chunk, guessed_formats)
+            yield len(chunk), trips, stages
+        return
+
+    pending: Deque[Tuple[int, Future]] = collections.deque()
+    merged_first = False
+    for chunk in chunks:
+        pending.append(
+            (len(chunk), executor.submit(merge, chunk, dict(guessed_formats)))
+        )
+        while pending and (len(pending) >= window or not merged_first):
+            rows, future = pending.popleft()
+            trips, guessed_formats, stages = future.result()
+            merged_first = True
+            yield rows, trips, stages
+    while pending:
+        rows, future = pending.popleft()
+        trips, _, stages = future.result()
+        yield rows, trips, stages
+
+
+def iter_trip_chunks(
+    cached_files: List[CachedFileInfo],
+    trip_sample: SampleConfig,
+    trip_parsers: List[ColumnParser],
+    ignore_cols: Set[str],
+    station_parsers: Optional[List[ColumnParser]] = None,
+    chunksize: int = DEFAULT_CHUNKSIZE,
+    compact: bool = False,
+    date_range: Optional[DateRange] = None,
+    catalog: Optional[SchemaCatalog] = None,
+    engine: CsvEngine = CsvEngine.PANDAS,
+    member_samples: Optional[Dict[Tuple[str, str], SampleConfig]] = None,
+    recorder: Optional[StageRecorder] = None,
+    workers: int = 1,
+    executor: Optional[Executor] = None,
+) -> Iterator[pd.DataFrame]:
+    """Stream trips mapped to the standard columns from cached files in chunks
+
+    Unlike open_and_concat_paths, at most one chunk per worker is held in memory
+    at a time. Chunks are read in order and mapped in executor, or in a parse
+    executor of workers kept until the last chunk is yielded, serially with one.
+    member_samples overrides trip_sample for the CSVs it has, by archive and name.
+    Stages are recorded per chunk, as chunks are consumed.
+    """
+    trip_parse_config = dtype_mapping(trip_parsers)
+
+    trip_cols = get_columns_parsed(trip_parsers)
+    station_cols = get_columns_parsed(station_parsers) if station_parsers else set()
+    columns_found: Set[str] = set()
+
+    with contextlib.ExitStack() as stack:
+        if executor is None and workers > 1:
+            executor = stack.enter_context(parse_executor(workers))
+        for cached_file_info in cached_files:
+            try:
+                for name, size_bytes, f in iter_csv_members(
+                    cached_file_info, date_range
+                ):
+                    schema = catalog_member(
+                        catalog,
+                        cached_file_info,
+                        name,
+                        size_bytes,
+                        f,
+                        trip_cols,
+                        station_cols,
+                    )
+                    header = schema.header
+                    filetype = determine_filetype(
+                        trip_cols=trip_cols,
+                        station_cols=station_cols,
+                        header=header,
+                    )
+                    if filetype != FileType.TRIPS:
+                        continue
+
+                    columns_found.update(header)
+                    sample = (member_samples or {}).get(
+                        (cached_file_info.remote_path, name), trip_sample
+                    )
+                    merge = functools.partial(
+                        merge_trip_chunk,
+                        trip_parsers,
+                        compact=compact,
+                        date_range=date_range,
+                        recorder=recorder.fork(
+                            archive=cached_file_info.remote_path, member=name
+                        )
+                        if recorder
+                        else None,
+                    )
+                    count = RowCount()
+                    rows_parsed = 0
+                    chunks = iter_csv_chunks(
+                        open_sampled_csv(f, sample, name, count),
+                        engine=engine,
+                        dtypes=trip_parse_config.dtypes,
+                        usecols=project_columns(header, trip_parsers),
+                        chunksize=chunksize,
+                    )
+                    for rows, trips, stages in merge_trip_chunks(
+                        chunks, merge, executor, window=workers
+                    ):
+                        rows_parsed += rows
+                        if recorder:
+                            recorder.extend(stages)
+                        yield trips
+                    catalog_rows(
+                        catalog,
+                        cached_file_info,
+                        name,
+                        schema,
+                        csv_rows(sample, count, rows_parsed),
+                    )
+            except Exception:
+                logger.exception(
+                    f"Failed to open cached file {cached_file_info.local_path} from {cached_file_info.remote_path}"
+                )
+                continue
+
+    if catalog:
+        catalog.save()
+    log_csv_column_results(columns_found, trip_parsers, ignore_cols, log_label="Trips")
+
+
+def parse_executor(workers: int) -> Executor:
+    """Where CSVs are parsed off the event loop, a process pool when parallel"""
+    if workers > 1:
+        return ProcessPoolExecutor(max_workers=workers)
+    return ThreadPoolExecutor(max_workers=1)
+
+
+async def async_download_and_parse(
+    data_dir_path: str,
+    urls: Iterable[str],
+    parse: Callable[[MemberTask], Optional[MemberResult]],
+    executor: Executor,
+    config: Optional[DownloadConfig] = None,
+    remote_zip: bool = False,
+    date_range: Optional[DateRange] = None,
+    scheduler: Optional[DownloadScheduler] = None,
+    catalog: Optional[SchemaCatalog] = None,
+    recorder: Optional[StageRecorder] = None,
+) -> List[Optional[MemberResult]]:
+    """Download archives, handing each one to the executor as soon as it lands
+
+    Parsing never runs on the event loop, so downloads keep going while pandas
+    works. Results are in url order whatever order the downloads finish in. With
+    remote_zip, only the members that will be parsed are fetched. Downloads are
+    recorded per archive, their time including waits for connections.
+    """
+    loop = asyncio.get_running_loop()
+    download_scheduler = scheduler or DownloadScheduler(config or DownloadConfig())
+
+    async def download_and_parse(
+        session: aiohttp.ClientSession, url: str
+    ) -> List[Optional[MemberResult]]:
+        with record_stage(recorder, "download", archive=url) as metrics:
+            if remote_zip:
+                cached_file_info = await download_zip_members_with_retry(
+                    data_dir_path=data_dir_path,
+                    session=session,
+                    url=url,
+                    want_member=functools.partial(wants_member, date_range=date_range),
+                    scheduler=download_scheduler,
+                )
+            else:
+                cached_file_info = await download_url_with_retry(
+                    data_dir_path=data_dir_path,
+                    session=session,
+                    url=url,
+                    scheduler=download_scheduler,
+                )
+            metrics.bytes_read = cached_file_info.downloaded_bytes
+        tasks = await loop.run_in_executor(
+            None, list_member_tasks, [cached_file_info], date_range, catalog
+        )
+        results = await asyncio.gather(
+            *[loop.run_in_executor(executor, parse, task) for task in tasks]
+        )
+        return list(catalog_results(catalog, tasks, results))
+
+    logger.debug(f"working dir: {data_dir_path}")
+    async with download_scheduler.session() as session:
+        results_per_url = await asyncio.gather(
+            *[download_and_parse(session, url) for url in urls]
+        )
+    if catalog:
+        catalog.save()
+    return [result for results in results_per_url for result in results]
+
+
+def archive_changed(
+    cached_file_info: CachedFileInfo, known_version: Optional[RemoteVersion]
+) -> bool:
+    """Whether an archive differs from the version of it already processed
+
+    Archives processed without validators can't be compared, so they only count
+    as changed when they're downloaded again.
+    """
+    if known_version is None:
+        return True
+    elif not known_version.conditional_headers():
+        return cached_file_info.download_sec is not None
+    return cached_file_info.version != known_version
@@ -0,0 +1,54 @@
+import json
+import os
+from dataclasses import asdict
+from dataclasses import dataclass
+from typing import Dict
+from typing import Optional
+from urllib.parse import unquote
+from urllib.parse import urlsplit
+
+from opendata.sources.bikeshare.downloads import RemoteVersion
+
+MANIFEST_FILENAME = "manifest.json"
+
+
+@dataclass
+class ManifestEntry:
+    """An archive written to the output, and the version of it that was written"""
+
+    url: str
+    partition: str
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    # Fingerprint of the sample and parse settings the partition was written with
+    settings: Optional[str] = None
+
+    @property
+    def version(self) -> RemoteVersion:
+        return RemoteVersion(etag=self.etag, last_modified=self.last_modified)
+
+
+def manifest_path(output_dir: str) -> str:
+    return os.path.join(output_dir, MANIFEST_FILENAME)
+
+
+def partition_name(url: str) -> str:
+    """Name an archive's output after its file, e.g. 202301-divvy-tripdata"""
+    return os.path.splitext(os.path.basename(unquote(urlsplit(url).path)))[0]
+
+
+def load_manifest(path: str) -> Dict[str, ManifestEntry]:
+    if not os.path.exists(path):
+        return {}
+
+    with open(path) as f:
+        entries = json.load(f)
+    return {entry["url"]: ManifestEntry(**entry) for entry in entries}
+
+
+def save_manifest(path: str, manifest: Dict[str, ManifestEntry]) -> None:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump([asdict(entry) for entry in manifest.values()], f, indent=2)
+    os.replace(tmp_path, path)
@@ -0,0 +1,351 @@
+"""Parse the CSVs inside cached archives, one member at a time
+
+A member is listed as a task that can be sent to a worker process, and parsed
+into a result carrying its frame, its schema for the catalog and the stages it
+recorded. Parsed members can be cached as Parquet between runs.
+"""
+import logging
+from dataclasses import dataclass
+from dataclasses import field
+from dataclasses import replace
+from typing import Dict
+from typing import IO
+from typing import Iterable
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Set
+from typing import Tuple
+from zipfile import ZipFile
+
+import pandas as pd
+
+from opendata.sources.bikeshare.catalog import MemberSchema
+from opendata.sources.bikeshare.catalog import SchemaCatalog
+from opendata.sources.bikeshare.columns import downcast_columns
+from opendata.sources.bikeshare.columns import merge_columns
+from opendata.sources.bikeshare.csv_readers import CsvEngine
+from opendata.sources.bikeshare.csv_readers import read_csv
+from opendata.sources.bikeshare.downloads import CachedFileInfo
+from opendata.sources.bikeshare.instrumentation import record_stage
+from opendata.sources.bikeshare.instrumentation import StageMetrics
+from opendata.sources.bikeshare.instrumentation import StageRecorder
+from opendata.sources.bikeshare.parsed_cache import archive_identity
+from opendata.sources.bikeshare.parsed_cache import cached_frame_path
+from opendata.sources.bikeshare.parsed_cache import fingerprint
+from opendata.sources.bikeshare.parsed_cache import load_cached_frame
+from opendata.sources.bikeshare.parsed_cache import save_cached_frame
+from opendata.sources.bikeshare.parsers import ColumnParser
+from opendata.sources.bikeshare.parsers import determine_filetype
+from opendata.sources.bikeshare.parsers import dtype_mapping
+from opendata.sources.bikeshare.parsers import FileType
+from opendata.sources.bikeshare.parsers import get_columns_parsed
+from opendata.sources.bikeshare.parsers import project_columns
+from opendata.sources.bikeshare.parsers import read_csv_header
+from opendata.sources.bikeshare.periods import DateRange
+from opendata.sources.bikeshare.sampling import open_sampled_csv
+from opendata.sources.bikeshare.sampling import RowCount
+from opendata.sources.bikeshare.sampling import SampleConfig
+
+logger = logging.getLogger(__name__)
+
+
+def sniff_member(
+    csv_file: IO, size_bytes: int, trip_cols: Set[str], station_cols: Set[str]
+) -> MemberSchema:
+    """Read a CSV's header, leaving it ready to be read again
+
+    Rows are left uncounted, they're counted when the CSV is read in full.
+    """
+    header = read_csv_header(csv_file)
+    return MemberSchema(
+        header=header,
+        filetype=determine_filetype(
+            trip_cols=trip_cols, station_cols=station_cols, header=header
+        ).name,
+        rows=None,
+        size_bytes=size_bytes,
+    )
+
+
+def catalog_member(
+    catalog: Optional[SchemaCatalog],
+    cached_file_info: CachedFileInfo,
+    name: str,
+    size_bytes: int,
+    csv_file: IO,
+    trip_cols: Set[str],
+    station_cols: Set[str],
+) -> MemberSchema:
+    """The cataloged schema of a CSV, sniffing and cataloging it if there's none"""
+    schema = catalog.get(cached_file_info, name) if catalog else None
+    if schema is None:
+        schema = sniff_member(csv_file, size_bytes, trip_cols, station_cols)
+        if catalog:
+            catalog.add(cached_file_info, name, schema)
+    return schema
+
+
+def catalog_rows(
+    catalog: Optional[SchemaCatalog],
+    cached_file_info: CachedFileInfo,
+    name: str,
+    schema: MemberSchema,
+    rows: Optional[int],
+) -> None:
+    """Catalog the rows of a CSV just read in full, unless they're known already"""
+    if catalog and schema.rows is None and rows is not None:
+        catalog.add(cached_file_info, name, replace(schema, rows=rows))
+
+
+def csv_rows(sample: SampleConfig, count: RowCount, rows_parsed: int) -> int:
+    """Rows of a CSV read in full, those parsed unless it was sampled"""
+    if sample.keeps_all_rows or count.rows is None:
+        return rows_parsed
+    return count.rows
+
+
+def is_csv_member(name: str) -> bool:
+    # __MACOSX directory includes CSV files we don't want
+    return not name.startswith("__MACOSX") and name.endswith("csv")
+
+
+def filter_trips(
+    trips_df: pd.DataFrame, date_range: Optional[DateRange] = None
+) -> pd.DataFrame:
+    """Keep the trips that started in date_range, all of them without one"""
+    if date_range is None:
+        return trips_df
+    return trips_df[date_range.contains(trips_df["started_at"])]
+
+
+def wants_member(name: str, date_range: Optional[DateRange] = None) -> bool:
+    """Whether a member is worth parsing, judging only by its name"""
+    return is_csv_member(name) and (date_range is None or date_range.may_contain(name))
+
+
+def list_csv_members(
+    zip: ZipFile,
+    cached_file_info: CachedFileInfo,
+    date_range: Optional[DateRange] = None,
+) -> List[str]:
+    """The names of the CSVs inside a zip file worth parsing"""
+    names = []
+    for zipinfo in zip.infolist():
+        if cached_file_info.members is not None:
+            # Only some members of a remote zip were fetched
+            if zipinfo.filename in cached_file_info.members:
+                names.append(zipinfo.filename)
+        elif wants_member(zipinfo.filename, date_range):
+            names.append(zipinfo.filename)
+        elif not is_csv_member(zipinfo.filename):
+            if not zipinfo.filename.startswith("__MACOSX"):
+                logger.warning(f"Unexpected file: {zipinfo.filename}")
+        else:
+            logger.debug(f"Skipping {zipinfo.filename}, it's outside {date_range}")
+    return names
+
+
+def iter_csv_members(
+    cached_file_info: CachedFileInfo, date_range: Optional[DateRange] = None
+) -> Iterator[Tuple[str, int, IO]]:
+    """Yield the name, uncompressed size and an open handle of each CSV inside a
+    cached zip file"""
+    with ZipFile(cached_file_info.local_path) as zip:
+        for name in list_csv_members(zip, cached_file_info, date_range):
+            with zip.open(name) as f:
+                yield name, zip.getinfo(name).file_size, f
+
+
+@dataclass
+class MemberTask:
+    cached_file_info: CachedFileInfo
+    name: str
+    schema: Optional[MemberSchema] = None  # from the catalog, sniffed if None
+
+
+@dataclass
+class MemberResult:
+    filetype: FileType
+    header: List[str]
+    df: pd.DataFrame
+    schema: Optional[MemberSchema] = None  # when sniffed or counted, to be cataloged
+    metrics: List[StageMetrics] = field(default_factory=list)
+
+
+def list_member_tasks(
+    cached_files: List[CachedFileInfo],
+    date_range: Optional[DateRange] = None,
+    catalog: Optional[SchemaCatalog] = None,
+) -> List[MemberTask]:
+    """One task per CSV inside the cached zip files, in a deterministic order"""
+    tasks: List[MemberTask] = []
+    for cached_file_info in cached_files:
+        try:
+            with ZipFile(cached_file_info.local_path) as zip:
+                tasks.extend(
+                    MemberTask(
+                        cached_file_info=cached_file_info,
+                        name=name,
+                        schema=catalog.get(cached_file_info, name) if catalog else None,
+                    )
+                    for name in list_csv_members(zip, cached_file_info, date_range)
+                )
+        except:
+            logger.exception(
+                f"Failed to open cached file {cached_file_info.local_path} from {cached_file_info.remote_path}"
+            )
+            continue
+    return tasks
+
+
+def catalog_results(
+    catalog: Optional[SchemaCatalog],
+    tasks: Iterable[MemberTask],
+    results: Iterable[Optional[MemberResult]],
+) -> Iterator[Optional[MemberResult]]:
+    """Pass results through, cataloging the CSVs sniffed or counted to parse them"""
+    for task, result in zip(tasks, results):
+        if catalog and result and result.schema:
+            catalog.add(task.cached_file_info, task.name, result.schema)
+        yield result
+
+
+def parse_member(
+    task: MemberTask,
+    trip_sample: SampleConfig,
+    trip_parsers: List[ColumnParser],
+    station_parsers: Optional[List[ColumnParser]],
+    raw_data: bool,
+    cache_dir: Optional[str] = None,
+    compact: bool = False,
+    date_range: Optional[DateRange] = None,
+    engine: CsvEngine = CsvEngine.PANDAS,
+    downcast: bool = False,
+    member_samples: Optional[Dict[Tuple[str, str], SampleConfig]] = None,
+    recorder: Optional[StageRecorder] = None,
+) -> Optional[MemberResult]:
+    """Parse a single CSV inside a cached zip file
+
+    This is a module level function so it can be sent to worker processes. With a
+    cache_dir, the parsed frame is saved as Parquet and reused by later runs as long
+    as the archive, parsers and sample settings are unchanged. Trips are cached
+    before filtering by date_range, so runs over other dates reuse them. downcast
+    casts trip columns to their parser's downcast_dtype. member_samples overrides
+    trip_sample for the CSVs it has, by archive and name. Stages are recorded in
+    a fork of recorder and returned with the result.
+    """
+    trip_cols = get_columns_parsed(trip_parsers)
+    station_cols = get_columns_parsed(station_parsers) if station_parsers else set()
+    cached_file_info = task.cached_file_info
+    stages = (
+        recorder.fork(archive=cached_file_info.remote_path, member=task.name)
+        if recorder
+        else None
+    )
+    if member_samples:
+        trip_sample = member_samples.get(
+            (cached_file_info.remote_path, task.name), trip_sample
+        )
+
+    cache_path = None
+    if cache_dir:
+        cache_path = cached_frame_path(
+            cache_dir,
+            fingerprint(
+                cached_file_info.remote_path,
+                archive_identity(cached_file_info.local_path),
+                task.name,
+                trip_sample,
+                trip_parsers,
+                station_parsers,
+                raw_data,
+                compact,
+                engine,
+                downcast,
+            ),
+        )
+        with record_stage(stages, "read_cache") as metrics:
+            cached = load_cached_frame(cache_path)
+            metrics.rows_out = len(cached[0]) if cached else None
+        if cached:
+            df, metadata = cached
+            logger.debug(f"Parsed {task.name} cached at {cache_path}")
+            filetype = FileType[metadata["filetype"]]
+            return MemberResult(
+                filetype=filetype,
+                header=metadata["header"],
+                df=filter_trips(df, date_range)
+                if filetype == FileType.TRIPS and not raw_data
+                else df,
+                metrics=stages.stages if stages else [],
+            )
+
+    try:
+        with ZipFile(cached_file_info.local_path) as zip, zip.open(task.name) as f:
+            size_bytes = zip.getinfo(task.name).file_size
+            schema = task.schema or sniff_member(f, size_bytes, trip_cols, station_cols)
+            header = schema.header
+            # Classified again in case the parsers changed since it was cataloged
+            filetype = determine_filetype(
+                trip_cols=trip_cols,
+                station_cols=station_cols,
+                header=header,
+            )
+            if filetype == FileType.TRIPS:
+                with record_stage(stages, "read_csv", bytes_read=size_bytes) as metrics:
+                    count = RowCount()
+                    df = read_csv(
+                        open_sampled_csv(f, trip_sample, task.name, count),
+                        engine=engine,
+                        dtypes=dtype_mapping(trip_parsers).dtypes,
+                        usecols=None
+                        if raw_data
+                        else project_columns(header, trip_parsers),
+                    )
+                    metrics.rows_out = len(df)
+                    # Rows of the CSV, sampled out or not
+                    metrics.rows_in = rows = csv_rows(trip_sample, count, len(df))
+                if not raw_data:
+                    df = merge_columns(
+                        trip_parsers, df, compact=compact, recorder=stages
+                    )
+                    if downcast:
+                        df = downcast_columns(trip_parsers, df)
+            elif filetype == FileType.STATIONS and station_parsers:
+                with record_stage(stages, "read_csv", bytes_read=size_bytes) as metrics:
+                    df = read_csv(
+                        f,
+                        engine=engine,
+                        dtypes=dtype_mapping(station_parsers).dtypes,
+                        usecols=None
+                        if raw_data
+                        else project_columns(header, station_parsers),
+                    )
+                    metrics.rows_in = metrics.rows_out = rows = len(df)
+                if not raw_data:
+                    df = merge_columns(
+                        station_parsers, df, compact=compact, recorder=stages
+                    )
+            else:
+                return None
+    except Exception:
+        logger.exception(
+            f"Failed to parse {task.name} in cached file {cached_file_info.local_path} from {cached_file_info.remote_path}"
+        )
+        return None
+
+    if cache_path:
+        save_cached_frame(cache_path, df, {"filetype": filetype.name, "header": header})
+    if schema.rows is None:
+        schema = replace(schema, rows=rows)
+
+    if filetype == FileType.TRIPS and not raw_data:
+        df = filter_trips(df, date_range)
+    return MemberResult(
+        filetype=filetype,
+        header=header,
+        df=df,
+        schema=None if schema == task.schema else schema,
+        metrics=stages.stages if stages else [],
+    )
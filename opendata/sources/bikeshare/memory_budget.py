@@ -0,0 +1,67 @@
+"""Estimate the memory loaded trips take, before loading them
+
+Trips are counted from the catalog where CSVs were cataloged before, and from
+their uncompressed size in the zip directory otherwise. Each trip then costs
+the sum of its columns: the itemsize of numeric and datetime columns, a Python
+string object per value for strings, and the codes of categoricals.
+"""
+import math
+from typing import Iterable
+from typing import Tuple
+
+import pandas as pd
+
+from opendata.sources.bikeshare.catalog import MemberSchema
+
+# CSV bytes per trip when no CSV of the market is cataloged yet, on the short
+# side of what markets publish so trips are overcounted rather than undercounted
+DEFAULT_BYTES_PER_LINE = 100
+# A short Python str and the pointer to it
+STRING_VALUE_BYTES = 64
+# int16 codes, enough for the stations of any market
+CATEGORY_CODE_BYTES = 2
+# The int64 index left by concatenating trips
+INDEX_BYTES = 8
+
+
+def value_bytes(dtype: str, categorical: bool = False) -> int:
+    """Bytes a single value of a column takes in memory"""
+    if categorical:
+        return CATEGORY_CODE_BYTES
+    elif dtype == "string":
+        return STRING_VALUE_BYTES
+    return pd.api.types.pandas_dtype(dtype).itemsize
+
+
+def row_bytes(columns: Iterable[Tuple[str, bool]]) -> int:
+    """Bytes a trip takes in memory, given the dtype and categorical of each column"""
+    return INDEX_BYTES + sum(
+        value_bytes(dtype, categorical) for dtype, categorical in columns
+    )
+
+
+def bytes_per_line(schemas: Iterable[MemberSchema]) -> float:
+    """Average CSV bytes per trip of the cataloged trip CSVs with counted rows"""
+    rows = 0
+    size_bytes = 0
+    for schema in schemas:
+        if schema.rows is None:
+            continue
+        rows += schema.rows
+        size_bytes += schema.size_bytes
+    return size_bytes / rows if rows else DEFAULT_BYTES_PER_LINE
+
+
+def estimate_rows(size_bytes: int, line_bytes: float) -> int:
+    """Trips in a CSV that wasn't cataloged yet, from its uncompressed size"""
+    return math.ceil(size_bytes / line_bytes)
+
+
+def budget_sample_rate(
+    estimated_bytes: int, sample_rate: int, budget_bytes: int
+) -> int:
+    """The requested sample rate, or a higher one if that would exceed the budget
+
+    estimated_bytes is the size of every trip, without sampling.
+    """
+    return max(sample_rate, math.ceil(estimated_bytes / budget_bytes))
@@ -0,0 +1,89 @@
+import dataclasses
+import hashlib
+import json
+import logging
+import os
+from enum import Enum
+from typing import Any
+from typing import Dict
+from typing import Optional
+from typing import Tuple
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+logger = logging.getLogger(__name__)
+
+# Bump when parsing changes in a way the fingerprinted settings don't capture
+PARSED_CACHE_VERSION = 2
+
+METADATA_KEY = b"opendata"
+
+
+def encode_for_fingerprint(value: Any) -> Any:
+    if dataclasses.is_dataclass(value) and not isinstance(value, type):
+        return dataclasses.asdict(value)
+    elif isinstance(value, (set, frozenset)):
+        return sorted(value)
+    elif isinstance(value, Enum):
+        return value.value
+    raise TypeError(f"Can't fingerprint {value!r}")
+
+
+def fingerprint(*parts: Any) -> str:
+    """A stable hash of parser and sampling settings, independent of set order"""
+    encoded = json.dumps(
+        [PARSED_CACHE_VERSION, *parts], default=encode_for_fingerprint, sort_keys=True
+    )
+    return hashlib.sha256(encoded.encode("utf-8")).hexdigest()
+
+
+def archive_identity(local_path: str) -> Tuple[int, int]:
+    """Size and modification time of a cached archive, which change on re-download"""
+    stat = os.stat(local_path)
+    return stat.st_size, stat.st_mtime_ns
+
+
+def cached_frame_path(cache_dir: str, key: str) -> str:
+    return os.path.join(cache_dir, f"{key}.parquet")
+
+
+def load_cached_frame(path: str) -> Optional[Tuple[pd.DataFrame, Dict[str, Any]]]:
+    """Read a frame and its metadata back, or None if it was never cached"""
+    if not os.path.exists(path):
+        return None
+
+    try:
+        table = pq.read_table(path)
+    except Exception:
+        logger.exception(f"Ignoring unreadable parsed cache file {path}")
+        return None
+
+    metadata = json.loads((table.schema.metadata or {}).get(METADATA_KEY, b"{}"))
+    return table.to_pandas(), metadata
+
+
+def save_cached_frame(path: str, df: pd.DataFrame, metadata: Dict[str, Any]) -> None:
+    """Cache a frame and its metadata as Parquet
+
+    Failures are only logged, leaving no file behind, since the cache is an
+    optimization and the frame is parsed again next time.
+    """
+    tmp_path = path + ".tmp"
+    try:
+        table = pa.Table.from_pandas(df, preserve_index=False)
+        table = table.replace_schema_metadata(
+            {
+                **(table.schema.metadata or {}),
+                METADATA_KEY: json.dumps(metadata).encode("utf-8"),
+            }
+        )
+
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        pq.write_table(table, tmp_path)
+        os.replace(tmp_path, path)
+    except Exception:
+        logger.exception(f"Failed to write parsed cache file {path}")
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
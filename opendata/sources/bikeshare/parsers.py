@@ -0,0 +1,309 @@
+"""Column parsers mapping each market's CSV columns to the standard ones
+
+Markets declare the columns each standard column may come from, and the parsers
+say which columns of a CSV are read, with what dtypes, and whether a CSV holds
+trips or stations.
+"""
+import logging
+from dataclasses import dataclass
+from enum import auto
+from enum import Enum
+from typing import Dict
+from typing import IO
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Set
+
+import pandas as pd
+
+logger = logging.getLogger(__name__)
+
+
+@dataclass
+class ColumnParser:
+    to_column: str
+    from_columns: List[str]
+    dtype: str
+    remap_values: Optional[Dict[str, Set[str]]] = None
+    # Few distinct values, so stored as a pandas categorical in compact mode
+    categorical: bool = False
+    # Formats of datetime from_columns, others are guessed once per file
+    datetime_formats: Optional[Dict[str, str]] = None
+    # Units of datetime from_columns holding numbers since the epoch, e.g. "ms"
+    datetime_units: Optional[Dict[str, str]] = None
+    # Smaller dtype used when loading to a memory budget
+    downcast_dtype: Optional[str] = None
+
+    @property
+    def is_datetime(self) -> bool:
+        return self.dtype.startswith("datetime")
+
+
+class FileType(Enum):
+    UNKNOWN = auto()
+    TRIPS = auto()
+    STATIONS = auto()
+
+
+def create_trips_parsers(
+    started_at__cols: List[str],
+    ended_at__cols: List[str],
+    start_station_id__cols: List[str],
+    end_station_id__cols: List[str],
+    start_station_name__cols: List[str],
+    end_station_name__cols: List[str],
+    rideable_type__cols: List[str],
+    ride_id__cols: List[str],
+    start_lat__cols: List[str],
+    start_lng__cols: List[str],
+    end_lat__cols: List[str],
+    end_lng__cols: List[str],
+    gender__cols: List[str],
+    user_type__cols: List[str],
+    bike_id__cols: List[str],
+    birth_year__cols: List[str],
+    datetime_formats: Optional[Dict[str, str]] = None,
+    datetime_units: Optional[Dict[str, str]] = None,
+) -> List[ColumnParser]:
+    return [
+        ColumnParser(
+            to_column="started_at",
+            from_columns=started_at__cols,
+            dtype="datetime64[ns]",
+            datetime_formats=datetime_formats,
+            datetime_units=datetime_units,
+        ),
+        ColumnParser(
+            to_column="ended_at",
+            from_columns=ended_at__cols,
+            dtype="datetime64[ns]",
+            datetime_formats=datetime_formats,
+            datetime_units=datetime_units,
+        ),
+        ColumnParser(
+            to_column="start_station_id",
+            from_columns=start_station_id__cols,
+            dtype="string",
+            categorical=True,
+        ),
+        ColumnParser(
+            to_column="end_station_id",
+            from_columns=end_station_id__cols,
+            dtype="string",
+            categorical=True,
+        ),
+        ColumnParser(
+            to_column="start_station_name",
+            from_columns=start_station_name__cols,
+            dtype="string",
+            categorical=True,
+        ),
+        ColumnParser(
+            to_column="end_station_name",
+            from_columns=end_station_name__cols,
+            dtype="string",
+            categorical=True,
+        ),
+        ColumnParser(
+            to_column="rideable_type",
+            from_columns=rideable_type__cols,
+            dtype="string",
+            categorical=True,
+            remap_values={
+                "classic_bike": {"docked_bike", "classic_bike"},
+                "electric_bike": {"electric_bike"},
+            },
+        ),
+        ColumnParser(
+            to_column="ride_id",
+            from_columns=ride_id__cols,
+            dtype="string",
+        ),
+        ColumnParser(
+            to_column="start_lat",
+            from_columns=start_lat__cols,
+            dtype="float64",
+            downcast_dtype="float32",
+        ),
+        ColumnParser(
+            to_column="start_lng",
+            from_columns=start_lng__cols,
+            dtype="float64",
+            downcast_dtype="float32",
+        ),
+        ColumnParser(
+            to_column="end_lat",
+            from_columns=end_lat__cols,
+            dtype="float64",
+            downcast_dtype="float32",
+        ),
+        ColumnParser(
+            to_column="end_lng",
+            from_columns=end_lng__cols,
+            dtype="float64",
+            downcast_dtype="float32",
+        ),
+        ColumnParser(
+            to_column="gender",
+            from_columns=gender__cols,
+            dtype="string",
+            categorical=True,
+            remap_values={
+                "N/A": {"0"},  # N/A maps to null in the remapper
+                "male": {"1", "male"},
+                "female": {"2", "female"},
+            },
+        ),
+        ColumnParser(
+            to_column="user_type",
+            from_columns=user_type__cols,
+            dtype="string",
+            categorical=True,
+            remap_values={
+                "casual": {
+                    "customer",
+                    "casual",
+                    "0",
+                },  # bixi uses 1 to indicate membership
+                "member": {"subscriber", "member", "1"},
+            },
+        ),
+        ColumnParser(
+            to_column="bike_id",
+            from_columns=bike_id__cols,
+            dtype="string",
+        ),
+        ColumnParser(
+            to_column="birth_year",
+            from_columns=birth_year__cols,
+            dtype="string",
+            downcast_dtype="Int16",
+        ),
+    ]
+
+
+def create_stations_parsers(
+    id__cols: List[str],
+    name__cols: List[str],
+    lat__cols: List[str],
+    lng__cols: List[str],
+    created_at__cols: List[str],
+    is_active__cols: List[str],
+    datetime_formats: Optional[Dict[str, str]] = None,
+    datetime_units: Optional[Dict[str, str]] = None,
+) -> List[ColumnParser]:
+    return [
+        ColumnParser(
+            to_column="station__id",
+            from_columns=id__cols,
+            dtype="string",
+        ),
+        ColumnParser(
+            to_column="station__name",
+            from_columns=name__cols,
+            dtype="string",
+        ),
+        ColumnParser(
+            to_column="station__lat",
+            from_columns=lat__cols,
+            dtype="float64",
+        ),
+        ColumnParser(
+            to_column="station__lng",
+            from_columns=lng__cols,
+            dtype="float64",
+        ),
+        ColumnParser(
+            to_column="station__created_at",
+            from_columns=created_at__cols,
+            dtype="datetime64[ns]",
+            datetime_formats=datetime_formats,
+            datetime_units=datetime_units,
+        ),
+        ColumnParser(
+            to_column="station__is_active",
+            from_columns=is_active__cols,
+            dtype="string",
+        ),
+    ]
+
+
+@dataclass
+class ParseConfig:
+    dtypes: Dict[str, str]
+
+
+def dtype_mapping(parsers: List[ColumnParser]) -> ParseConfig:
+    """Return the dtypes to be used when parsing the CSV file
+
+    Datetime columns are read as text, or as numbers when they have a unit, and
+    parsed by merge_columns.
+    """
+    dtypes = {}
+    for parser in parsers:
+        for column in parser.from_columns:
+            if not parser.is_datetime:
+                dtypes[column] = parser.dtype
+            elif parser.datetime_units and column in parser.datetime_units:
+                dtypes[column] = "float64"
+    return ParseConfig(dtypes=dtypes)
+
+
+def get_columns_parsed(parsers: List[ColumnParser]) -> Set[str]:
+    """A list of strings of column names the CSV parser will inspect"""
+    columns = set()
+    for parser in parsers:
+        columns.update(parser.from_columns)
+    return columns
+
+
+def read_csv_header(csv_file: IO) -> List[str]:
+    """Read only the header row of a CSV, leaving the file ready to be read again"""
+    header_df = pd.read_csv(csv_file, header=0, nrows=0)
+    csv_file.seek(0)  # we need to read the file again later, so reset
+    return list(header_df.columns)
+
+
+def project_columns(header: List[str], parsers: List[ColumnParser]) -> List[str]:
+    """The columns of a CSV header the parsers read, so the rest are never parsed"""
+    columns_parsed = get_columns_parsed(parsers)
+    return [column for column in header if column in columns_parsed]
+
+
+def determine_filetype(
+    trip_cols: Set[str], station_cols: Set[str], header: List[str]
+) -> FileType:
+    if not station_cols:
+        return FileType.TRIPS
+
+    if not header:
+        return FileType.TRIPS
+
+    columns_found = set(header)
+    if len(columns_found.intersection(trip_cols)) / len(trip_cols) > len(
+        columns_found.intersection(station_cols)
+    ) / len(station_cols):
+        return FileType.TRIPS
+    else:
+        return FileType.STATIONS
+
+
+def log_csv_column_results(
+    columns: Iterable[str],
+    parsers: List[ColumnParser],
+    ignore_cols: Set[str],
+    log_label: str,
+) -> None:
+    columns_found = set(columns) - ignore_cols
+    columns_expected = get_columns_parsed(parsers)
+
+    columns_parsed = columns_found.intersection(columns_expected)
+    columns_missing = columns_expected - columns_found
+    columns_unexpected = columns_found - columns_expected
+    if columns_parsed:
+        logger.info(f"{log_label} columns parsed: {columns_parsed}")
+    if columns_missing:
+        logger.warning(f"{log_label} columns missing: {columns_missing}")
+    if columns_unexpected:
+        logger.warning(f"{log_label} columns unexpected: {columns_unexpected}")
@@ -0,0 +1,87 @@
+import os
+import re
+from dataclasses import dataclass
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import pandas as pd
+
+# 202101-divvy-tripdata, OD_2014-04, Divvy_Trips_2015_07
+YEAR_MONTH = re.compile(r"(?<!\d)(20\d\d)[-_]?(0[1-9]|1[0-2])(?!\d)")
+# Divvy_Trips_2017_Q1, Divvy_Trips_2016_Q1Q2, indego-trips-2022-q1
+YEAR_QUARTERS = re.compile(r"(?<!\d)(20\d\d)[-_ ]?((?:[Qq][1-4])+)(?!\d)")
+# la_metro_gbfs_trips_Q1_2019
+QUARTER_YEAR = re.compile(r"(?<![A-Za-z])[Qq]([1-4])[-_ ]?(20\d\d)(?!\d)")
+# 2017-fordgobike-tripdata, BixiMontrealRentals2019
+YEAR = re.compile(r"(?<!\d)(20\d\d)(?!\d)")
+
+Period = Tuple[pd.Timestamp, pd.Timestamp]
+
+
+def span(periods: List[Period]) -> Optional[Period]:
+    if not periods:
+        return None
+    return min(start for start, _ in periods), max(end for _, end in periods)
+
+
+def name_period(name: str) -> Optional[Period]:
+    """The [start, end) range of trips a file name says it holds, None if unsure
+
+    The most specific dates in the name win, so Divvy_Trips_2014-Q3-07 is Q3 of
+    2014 rather than all of 2014.
+    """
+    stem = os.path.basename(name)
+
+    months = [
+        pd.Period(year=int(year), month=int(month), freq="M")
+        for year, month in YEAR_MONTH.findall(stem)
+    ]
+    quarters = [
+        pd.Period(year=int(year), quarter=int(quarter), freq="Q")
+        for year, quarter_tokens in YEAR_QUARTERS.findall(stem)
+        for quarter in re.findall(r"[1-4]", quarter_tokens)
+    ] + [
+        pd.Period(year=int(year), quarter=int(quarter), freq="Q")
+        for quarter, year in QUARTER_YEAR.findall(stem)
+    ]
+    years = [pd.Period(year=int(year), freq="Y") for year in YEAR.findall(stem)]
+
+    for found in (months, quarters, years):
+        if found:
+            return span(
+                [(period.start_time, (period + 1).start_time) for period in found]
+            )
+    return None
+
+
+@dataclass
+class DateRange:
+    """Trips started in [start, end), either side may be open"""
+
+    start: Optional[pd.Timestamp] = None
+    end: Optional[pd.Timestamp] = None
+
+    def may_contain(self, name: str) -> bool:
+        """Whether a file could hold trips in range, judging only by its name"""
+        if "station" in name.lower():
+            # Station tables are needed whatever dates they were published on
+            return True
+
+        period = name_period(name)
+        if period is None:
+            return True
+
+        period_start, period_end = period
+        return (self.end is None or period_start < self.end) and (
+            self.start is None or period_end > self.start
+        )
+
+    def contains(self, started_at: pd.Series) -> pd.Series:
+        """Which trips started in range, those without a start never are"""
+        in_range = started_at.notna()
+        if self.start is not None:
+            in_range &= started_at >= self.start
+        if self.end is not None:
+            in_range &= started_at < self.end
+        return in_range
@@ -0,0 +1,314 @@
+"""Fetch only the members of a remote zip file we will parse
+
+A zip file ends with a central directory listing every member and where it
+starts. Reading it with Range requests first means junk, out of range months
+and anything else we skip are never downloaded. Fetched bytes are written at
+their original offsets into a sparse file, so ZipFile reads it like the whole
+archive as long as only fetched members are opened.
+"""
+import asyncio
+import json
+import logging
+import os
+import struct
+import time
+from dataclasses import asdict
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Callable
+from typing import Dict
+from typing import Iterable
+from typing import List
+from typing import Optional
+from typing import Tuple
+from zipfile import BadZipFile
+from zipfile import ZipFile
+from zipfile import ZipInfo
+
+import aiohttp
+
+from opendata.sources.bikeshare.downloads import CachedFileInfo
+from opendata.sources.bikeshare.downloads import download_url
+from opendata.sources.bikeshare.downloads import DownloadConfig
+from opendata.sources.bikeshare.downloads import DownloadScheduler
+from opendata.sources.bikeshare.downloads import file_path_for_url
+from opendata.sources.bikeshare.downloads import parse_content_range
+from opendata.sources.bikeshare.downloads import RemoteVersion
+from opendata.sources.bikeshare.downloads import retry_download
+from opendata.sources.bikeshare.downloads import RETRYABLE_STATUSES
+from opendata.sources.bikeshare.downloads import RetryableDownloadError
+from opendata.sources.bikeshare.downloads import USER_AGENT
+
+logger = logging.getLogger(__name__)
+
+# End of central directory record, its longest comment and the zip64 records
+TAIL_BYTES = 22 + 2**16 + 20 + 56
+
+EOCD_SIGNATURE = b"PK\x05\x06"
+ZIP64_LOCATOR_SIGNATURE = b"PK\x06\x07"
+ZIP64_EOCD_SIGNATURE = b"PK\x06\x06"
+
+
+class RangesNotSupported(Exception):
+    pass
+
+
+@dataclass
+class SparseZipMeta:
+    size: int
+    etag: Optional[str] = None
+    last_modified: Optional[str] = None
+    members: List[str] = field(default_factory=list)  # fetched so far
+
+    @property
+    def version(self) -> RemoteVersion:
+        return RemoteVersion(etag=self.etag, last_modified=self.last_modified)
+
+
+def sparse_zip_path(local_path: str) -> str:
+    return local_path + ".members.zip"
+
+
+def sparse_meta_path(path: str) -> str:
+    return path + ".json"
+
+
+def read_sparse_meta(path: str) -> Optional[SparseZipMeta]:
+    meta_path = sparse_meta_path(path)
+    if not os.path.exists(path) or not os.path.exists(meta_path):
+        return None
+
+    with open(meta_path) as f:
+        return SparseZipMeta(**json.load(f))
+
+
+def write_sparse_meta(path: str, meta: SparseZipMeta) -> None:
+    tmp_path = sparse_meta_path(path) + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(asdict(meta), f)
+    os.replace(tmp_path, sparse_meta_path(path))
+
+
+def discard_sparse_zip(path: str) -> None:
+    for discard_path in (path, sparse_meta_path(path)):
+        if os.path.exists(discard_path):
+            os.remove(discard_path)
+
+
+def write_at(path: str, offset: int, data: bytes) -> None:
+    with open(path, "r+b") as f:
+        f.seek(offset)
+        f.write(data)
+
+
+def central_directory_range(tail: bytes, tail_offset: int) -> Tuple[int, int]:
+    """Offset and size of the central directory, read from the end of a zip file"""
+    eocd = tail.rfind(EOCD_SIGNATURE)
+    if eocd < 0:
+        raise BadZipFile("No end of central directory record")
+    cd_size, cd_offset = struct.unpack("<LL", tail[eocd + 12 : eocd + 20])
+
+    if cd_size == 0xFFFFFFFF or cd_offset == 0xFFFFFFFF:
+        locator = eocd - 20
+        if tail[locator : locator + 4] != ZIP64_LOCATOR_SIGNATURE:
+            raise BadZipFile("No zip64 end of central directory locator")
+        (zip64_offset,) = struct.unpack("<Q", tail[locator + 8 : locator + 16])
+        record = zip64_offset - tail_offset
+        if record < 0 or tail[record : record + 4] != ZIP64_EOCD_SIGNATURE:
+            raise BadZipFile("No zip64 end of central directory record")
+        cd_size, cd_offset = struct.unpack("<QQ", tail[record + 40 : record + 56])
+
+    return cd_offset, cd_size
+
+
+def member_ranges(infos: List[ZipInfo], cd_offset: int) -> Dict[str, Tuple[int, int]]:
+    """The [start, end) bytes of each member, from its header to the next one"""
+    starts = sorted({info.header_offset for info in infos} | {cd_offset})
+    next_start = dict(zip(starts, starts[1:]))
+    return {
+        info.filename: (info.header_offset, next_start[info.header_offset])
+        for info in infos
+    }
+
+
+def coalesce_ranges(ranges: Iterable[Tuple[int, int]]) -> List[Tuple[int, int]]:
+    """Merge adjacent byte ranges so neighbouring members take one request"""
+    merged: List[Tuple[int, int]] = []
+    for start, end in sorted(ranges):
+        if merged and merged[-1][1] == start:
+            merged[-1] = (merged[-1][0], end)
+        else:
+            merged.append((start, end))
+    return merged
+
+
+async def fetch_range(
+    session: aiohttp.ClientSession,
+    url: str,
+    byte_range: str,
+    headers: Dict[str, str],
+    scheduler: Optional[DownloadScheduler] = None,
+) -> Tuple[bytes, Optional[int], RemoteVersion]:
+    """Fetch "bytes=<byte_range>" of url with the total size and file version"""
+    async with session.get(
+        url, headers={**headers, "Range": f"bytes={byte_range}"}
+    ) as resp:
+        if resp.status == 412:
+            raise RetryableDownloadError(f"{url} changed while fetching its members")
+        if resp.status in RETRYABLE_STATUSES:
+            raise RetryableDownloadError(
+                f"Range request status {resp.status} for {url}"
+            )
+        if resp.status != 206:
+            raise RangesNotSupported(f"Range request status {resp.status} for {url}")
+
+        data = await resp.read()
+        _, total = parse_content_range(resp.headers.get("Content-Range", ""))
+        version = RemoteVersion(
+            etag=resp.headers.get("ETag"),
+            last_modified=resp.headers.get("Last-Modified"),
+        )
+
+    if scheduler and scheduler.bandwidth:
+        await scheduler.bandwidth.consume(len(data))
+    return data, total, version
+
+
+async def download_zip_members(
+    data_dir_path: str,
+    session: aiohttp.ClientSession,
+    url: str,
+    want_member: Callable[[str], bool],
+    scheduler: Optional[DownloadScheduler] = None,
+) -> CachedFileInfo:
+    """Fetch the central directory of a remote zip, then the members we want
+
+    Falls back to downloading the whole archive from servers without Range support,
+    and uses the whole archive when it's already cached.
+    """
+    local_path = file_path_for_url(url=url, data_dir_path=data_dir_path)
+    if os.path.exists(local_path):
+        return await download_url(data_dir_path, session, url, scheduler=scheduler)
+
+    path = sparse_zip_path(local_path)
+    headers = {"User-Agent": USER_AGENT}
+    started_at = time.monotonic()
+    fetched_bytes = 0
+
+    meta = read_sparse_meta(path)
+    if meta is None:
+        try:
+            tail, total, version = await fetch_range(
+                session, url, f"-{TAIL_BYTES}", headers, scheduler
+            )
+        except RangesNotSupported:
+            logger.info(f"{url} doesn't support Range requests, downloading it all")
+            return await download_url(data_dir_path, session, url, scheduler=scheduler)
+
+        total = total or len(tail)
+        tail_offset = total - len(tail)
+        cd_offset, _ = central_directory_range(tail, tail_offset)
+        meta = SparseZipMeta(
+            size=total, etag=version.etag, last_modified=version.last_modified
+        )
+        with open(path, "wb") as f:
+            f.truncate(total)  # sparse, only fetched ranges take up disk space
+            f.seek(tail_offset)
+            f.write(tail)
+        fetched_bytes += len(tail)
+
+        if cd_offset < tail_offset:
+            cd, _, _ = await fetch_range(
+                session,
+                url,
+                f"{cd_offset}-{tail_offset - 1}",
+                {**headers, **meta.version.precondition_headers()},
+                scheduler,
+            )
+            write_at(path, cd_offset, cd)
+            fetched_bytes += len(cd)
+        write_sparse_meta(path, meta)
+
+    with ZipFile(path) as zip:
+        infos = zip.infolist()
+        ranges = member_ranges(infos, cd_offset=zip.start_dir)
+
+    wanted = [info.filename for info in infos if want_member(info.filename)]
+    missing = [name for name in wanted if name not in meta.members]
+    for start, end in coalesce_ranges(ranges[name] for name in missing):
+        try:
+            data, _, _ = await fetch_range(
+                session,
+                url,
+                f"{start}-{end - 1}",
+                {**headers, **meta.version.precondition_headers()},
+                scheduler,
+            )
+        except RetryableDownloadError:
+            # The archive may have changed, start over from its central directory
+            discard_sparse_zip(path)
+            raise
+        write_at(path, start, data)
+        fetched_bytes += len(data)
+
+    if missing:
+        meta.members = sorted(set(meta.members) | set(missing))
+        write_sparse_meta(path, meta)
+        logger.info(
+            f"Fetched {len(missing)} of {len(infos)} members of {url} "
+            f"({fetched_bytes / 2**20:.1f} of {meta.size / 2**20:.1f} MiB)"
+        )
+
+    return CachedFileInfo(
+        local_path=path,
+        remote_path=url,
+        size_bytes=fetched_bytes,
+        download_sec=time.monotonic() - started_at if fetched_bytes else None,
+        downloaded_bytes=fetched_bytes,
+        version=meta.version,
+        members=wanted,
+    )
+
+
+async def download_zip_members_with_retry(
+    data_dir_path: str,
+    session: aiohttp.ClientSession,
+    url: str,
+    want_member: Callable[[str], bool],
+    scheduler: Optional[DownloadScheduler] = None,
+) -> CachedFileInfo:
+    scheduler = scheduler or DownloadScheduler(DownloadConfig())
+    return await retry_download(
+        url,
+        lambda: download_zip_members(
+            data_dir_path=data_dir_path,
+            session=session,
+            url=url,
+            want_member=want_member,
+            scheduler=scheduler,
+        ),
+        scheduler=scheduler,
+    )
+
+
+async def async_download_zip_members(
+    data_dir_path: str,
+    urls: Iterable[str],
+    want_member: Callable[[str], bool],
+    config: Optional[DownloadConfig] = None,
+    scheduler: Optional[DownloadScheduler] = None,
+) -> List[CachedFileInfo]:
+    scheduler = scheduler or DownloadScheduler(config or DownloadConfig())
+    async with scheduler.session() as session:
+        return await asyncio.gather(
+            *[
+                download_zip_members_with_retry(
+                    data_dir_path=data_dir_path,
+                    session=session,
+                    url=url,
+                    want_member=want_member,
+                    scheduler=scheduler,
+                )
+                for url in urls
+            ]
+        )
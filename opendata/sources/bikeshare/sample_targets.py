@@ -0,0 +1,138 @@
+"""Per-file sample settings that keep a number of trips overall or per month
+
+One sample rate keeps the same share of every file, so small markets and early
+years come out nearly empty while the busiest years still dominate. Here every
+month gets the same quota of trips instead. Each file is sampled by how many
+trips it holds per month, and months with fewer trips than the quota keep all
+of theirs, leaving what they don't use to the others.
+"""
+import math
+from dataclasses import dataclass
+from dataclasses import replace
+from typing import Any
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import pandas as pd
+
+from opendata.sources.bikeshare.periods import DateRange
+from opendata.sources.bikeshare.periods import name_period
+from opendata.sources.bikeshare.sampling import SampleConfig
+from opendata.sources.bikeshare.sampling import SampleMethod
+
+DAYS_PER_MONTH = 365.25 / 12
+
+
+@dataclass
+class SampleTarget:
+    rows: Optional[int] = None  # trips overall
+    rows_per_month: Optional[int] = None
+
+    def __post_init__(self) -> None:
+        if (self.rows is None) == (self.rows_per_month is None):
+            raise ValueError("Set either a target of rows or of rows per month")
+
+
+@dataclass
+class FileEstimate:
+    rows: int  # trips in the file, estimated
+    period: Tuple[Any, ...]  # shared by files holding the same months
+    months: float  # months of the file's period within the date range
+    in_range: float = 1.0  # share of the file's period within the date range
+
+    @property
+    def rows_in_range(self) -> float:
+        return self.rows * self.in_range
+
+
+def months_between(start: pd.Timestamp, end: pd.Timestamp) -> float:
+    return max((end - start).days, 0) / DAYS_PER_MONTH
+
+
+def estimate_file(
+    rows: int, name: str, archive: str, date_range: Optional[DateRange] = None
+) -> FileEstimate:
+    """Size a file by the period its name, or else its archive's, says it holds
+
+    Files without a dated name are taken as a month of trips of their own.
+    """
+    period = name_period(name) or name_period(archive)
+    if period is None:
+        return FileEstimate(rows=rows, period=(archive, name), months=1.0)
+
+    start, end = period
+    months = months_between(start, end)
+    if date_range is not None:
+        start = max(start, date_range.start) if date_range.start else start
+        end = min(end, date_range.end) if date_range.end else end
+    months_in_range = months_between(start, end)
+    return FileEstimate(
+        rows=rows,
+        period=period,
+        months=months_in_range,
+        in_range=months_in_range / months if months else 1.0,
+    )
+
+
+def period_rows(files: List[FileEstimate]) -> Dict[Tuple[Any, ...], float]:
+    """Trips in range per period, summed over the files holding it"""
+    rows: Dict[Tuple[Any, ...], float] = {}
+    for file in files:
+        rows[file.period] = rows.get(file.period, 0.0) + file.rows_in_range
+    return rows
+
+
+def month_quota(files: List[FileEstimate], target: SampleTarget) -> float:
+    """Trips to keep per month so that all the files keep target trips
+
+    Periods are filled from the sparsest, each keeping all its trips while they
+    are fewer than the quota. Infinite when there are fewer trips than the
+    target.
+    """
+    if target.rows_per_month is not None:
+        return target.rows_per_month
+
+    assert target.rows is not None
+    months = {file.period: file.months for file in files if file.months > 0}
+    rows = period_rows(files)
+    remaining_rows = float(target.rows)
+    remaining_months = sum(months.values())
+    for period in sorted(months, key=lambda period: rows[period] / months[period]):
+        quota = remaining_rows / remaining_months
+        if rows[period] > quota * months[period]:
+            return quota
+        remaining_rows -= rows[period]
+        remaining_months -= months[period]
+    return math.inf
+
+
+def file_samples(
+    sample: SampleConfig, files: List[FileEstimate], quota: float
+) -> List[SampleConfig]:
+    """The sample settings keeping about quota trips per month of each file
+
+    Files holding the same period share its quota by their size. Reservoir
+    samples keep exactly their share. Other methods keep 1 in an integer rate,
+    the nearest to it. Files with no month in the date range keep a single trip,
+    the fewest a sample can, which is dropped with the other trips out of range.
+    """
+    rows = period_rows(files)
+    samples = []
+    for file in files:
+        wanted = quota * file.months
+        if file.months <= 0:
+            if sample.method == SampleMethod.RESERVOIR:
+                samples.append(replace(sample, size=1))
+            else:
+                samples.append(replace(sample, rate=max(file.rows, 1)))
+        elif wanted >= rows[file.period]:
+            samples.append(SampleConfig())  # every trip
+        elif sample.method == SampleMethod.RESERVOIR:
+            kept = math.ceil(file.rows * wanted / rows[file.period])
+            samples.append(replace(sample, size=max(kept, 1)))
+        else:
+            rate = round(rows[file.period] / wanted)
+            samples.append(replace(sample, rate=max(rate, 1)))
+    return samples
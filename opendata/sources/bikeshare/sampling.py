@@ -0,0 +1,206 @@
+import hashlib
+import io
+from dataclasses import dataclass
+from enum import Enum
+from typing import IO
+from typing import Iterator
+from typing import List
+from typing import Optional
+from typing import Tuple
+
+import numpy as np
+
+# Bytes of the decompressed stream scanned at a time
+BLOCK_SIZE = 2**22
+
+NEWLINE = ord("\n")
+
+
+class SampleMethod(Enum):
+    SYSTEMATIC = "systematic"  # every Nth row, what skiprows used to do
+    RANDOM = "random"  # each row independently with probability 1/N
+    RESERVOIR = "reservoir"  # a fixed number of rows per file, chosen uniformly
+
+
+@dataclass
+class SampleConfig:
+    rate: int = 1
+    method: SampleMethod = SampleMethod.SYSTEMATIC
+    seed: Optional[int] = None
+    size: Optional[int] = None  # rows kept per file by reservoir sampling
+
+    @property
+    def keeps_all_rows(self) -> bool:
+        return self.method != SampleMethod.RESERVOIR and self.rate <= 1
+
+
+@dataclass
+class RowCount:
+    """Rows of a CSV after its header, set once a sampler read all of them"""
+
+    rows: Optional[int] = None
+
+
+class IteratorStream(io.RawIOBase):
+    """Adapt an iterator of byte strings into a readable file object"""
+
+    def __init__(self, chunks: Iterator[bytes]):
+        self.chunks = chunks
+        self.pending = b""
+
+    def readable(self) -> bool:
+        return True
+
+    def readinto(self, buffer: bytearray) -> int:  # type: ignore[override]
+        while not self.pending:
+            try:
+                self.pending = next(self.chunks)
+            except StopIteration:
+                return 0
+
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
+
+
+def member_seed(seed: Optional[int], name: str) -> Optional[int]:
+    """Derive a stable per-file seed so a file's sample doesn't depend on load order"""
+    if seed is None:
+        return None
+
+    digest = hashlib.sha256(f"{seed}:{name}".encode("utf-8")).digest()
+    return int.from_bytes(digest[:8], "little")
+
+
+def iter_line_blocks(
+    csv_file: IO[bytes], block_size: int = BLOCK_SIZE
+) -> Iterator[Tuple[bytes, np.ndarray]]:
+    """Yield blocks of whole lines with the offset just past the end of each line
+
+    Newlines are located with numpy, so no Python code runs per line. Quoted
+    fields spanning several lines are not supported, bikeshare exports don't have
+    them.
+    """
+    remainder = b""
+    while True:
+        chunk = csv_file.read(block_size)
+        if not chunk:
+            break
+
+        block = remainder + chunk
+        ends = np.flatnonzero(np.frombuffer(block, dtype=np.uint8) == NEWLINE) + 1
+        if len(ends) == 0:
+            remainder = block
+            continue
+
+        remainder = block[ends[-1] :]
+        yield block[: ends[-1]], ends
+
+    if remainder:
+        yield remainder + b"\n", np.array([len(remainder) + 1])
+
+
+def line_starts(ends: np.ndarray) -> np.ndarray:
+    """The offset of the first byte of each line given the offsets past their ends"""
+    return np.concatenate((np.zeros(1, dtype=ends.dtype), ends[:-1]))
+
+
+def iter_sampled_lines(
+    csv_file: IO[bytes],
+    sample: SampleConfig,
+    name: str,
+    count: Optional[RowCount] = None,
+) -> Iterator[bytes]:
+    """Yield the header followed by the sampled lines of a CSV stream"""
+    rng = np.random.default_rng(member_seed(sample.seed, name))
+    rows_seen = 0
+    header_pending = True
+
+    for block, ends in iter_line_blocks(csv_file):
+        starts = line_starts(ends)
+        if header_pending:
+            yield block[: ends[0]]
+            starts, ends = starts[1:], ends[1:]
+            header_pending = False
+
+        if sample.method == SampleMethod.SYSTEMATIC:
+            # Keep rows where (row + 1) % rate == 0 across block boundaries
+            first = -(rows_seen + 1) % sample.rate
+            keep = np.arange(first, len(ends), sample.rate)
+        else:
+            keep = np.flatnonzero(rng.random(len(ends)) < 1 / sample.rate)
+
+        rows_seen += len(ends)
+        yield b"".join(block[starts[i] : ends[i]] for i in keep)
+
+    if count is not None:
+        count.rows = rows_seen
+
+
+def reservoir_sample_lines(
+    csv_file: IO[bytes],
+    sample: SampleConfig,
+    name: str,
+    count: Optional[RowCount] = None,
+) -> bytes:
+    """Return the header and a uniform sample of sample.size lines in file order
+
+    Every line gets a random key and the lines with the smallest keys are kept,
+    so each block is reduced with a single vectorized partition.
+    """
+    if not sample.size:
+        raise ValueError("Reservoir sampling requires a sample size")
+
+    rng = np.random.default_rng(member_seed(sample.seed, name))
+    header: Optional[bytes] = None
+    keys = np.empty(0)
+    rows = np.empty(0, dtype=np.int64)
+    lines: List[bytes] = []
+    rows_seen = 0
+
+    for block, ends in iter_line_blocks(csv_file):
+        starts = line_starts(ends)
+        if header is None:
+            header = block[: ends[0]]
+            starts, ends = starts[1:], ends[1:]
+
+        block_keys = rng.random(len(ends))
+        all_keys = np.concatenate((keys, block_keys))
+        if len(all_keys) > sample.size:
+            chosen = np.argpartition(all_keys, sample.size - 1)[: sample.size]
+        else:
+            chosen = np.arange(len(all_keys))
+
+        kept = chosen[chosen < len(keys)]
+        added = chosen[chosen >= len(keys)] - len(keys)
+        keys = np.concatenate((keys[kept], block_keys[added]))
+        rows = np.concatenate((rows[kept], rows_seen + added))
+        lines = [lines[i] for i in kept] + [block[starts[i] : ends[i]] for i in added]
+        rows_seen += len(ends)
+
+    if count is not None:
+        count.rows = rows_seen
+    in_file_order = np.argsort(rows, kind="stable")
+    return (header or b"") + b"".join(lines[i] for i in in_file_order)
+
+
+def open_sampled_csv(
+    csv_file: IO[bytes],
+    sample: SampleConfig,
+    name: str,
+    count: Optional[RowCount] = None,
+) -> IO[bytes]:
+    """Wrap a CSV stream so only the header and sampled rows reach read_csv
+
+    count gets the rows the CSV had once it's read to the end. Streams keeping
+    every row are passed through, their rows are those read_csv returns.
+    """
+    if sample.keeps_all_rows:
+        return csv_file
+    elif sample.method == SampleMethod.RESERVOIR:
+        return io.BytesIO(reservoir_sample_lines(csv_file, sample, name, count))
+    else:
+        return io.BufferedReader(
+            IteratorStream(iter_sampled_lines(csv_file, sample, name, count))
+        )
@@ -0,0 +1,74 @@
+"""Fill the station details of trips from the station table of a market"""
+from typing import Dict
+from typing import Tuple
+
+import numpy as np
+import pandas as pd
+
+# Trip columns filled from the station table, by the station id column they use
+STATION_FILL_COLUMNS = {
+    "start_station_id": {
+        "start_station_name": "station__name",
+        "start_lat": "station__lat",
+        "start_lng": "station__lng",
+    },
+    "end_station_id": {
+        "end_station_name": "station__name",
+        "end_lat": "station__lat",
+        "end_lng": "station__lng",
+    },
+}
+
+
+def index_stations(stations_df: pd.DataFrame) -> pd.DataFrame:
+    """Stations indexed by id, keeping the last entry of ids listed more than once"""
+    stations_df = stations_df.groupby("station__id").tail(1).set_index("station__id")
+    # pandas switches to integer types sometimes :(
+    stations_df.index = stations_df.index.astype("string")
+    return stations_df
+
+
+def fill_from_stations(
+    trips_df: pd.DataFrame,
+    stations_df: pd.DataFrame,
+    id_column: str,
+    columns: Dict[str, str],
+) -> None:
+    """Fill missing trip columns in place with those of the station of id_column
+
+    Only the distinct ids are looked up in the station index, and positions
+    rather than labels are used, since concatenated trips repeat index labels.
+    Each filled column keeps its dtype and the trips frame is never copied.
+    """
+    codes, ids = pd.factorize(trips_df[id_column])
+    id_positions = stations_df.index.get_indexer(pd.Index(ids).astype("string"))
+    positions = np.append(id_positions, -1)[codes]  # code -1 marks a null id
+    found = positions >= 0
+
+    for trip_column, station_column in columns.items():
+        missing = found & trips_df[trip_column].isna().to_numpy()
+        if not missing.any():
+            continue
+
+        col = trips_df[trip_column].copy()
+        values = stations_df[station_column].to_numpy()[positions[missing]]
+        if isinstance(col.dtype, pd.CategoricalDtype):
+            new_values = pd.unique(values[pd.notna(values)])
+            col = col.cat.add_categories(
+                [value for value in new_values if value not in col.cat.categories]
+            )
+        else:
+            # Cast to the trip column's dtype so assigning doesn't change it
+            values = pd.array(values, dtype=col.dtype)
+        col.iloc[np.flatnonzero(missing)] = values
+        trips_df[trip_column] = col
+
+
+def merge_stations_table(
+    trips_df: pd.DataFrame, stations_df: pd.DataFrame
+) -> Tuple[pd.DataFrame, pd.DataFrame]:
+    """Fill station names and coordinates of trips from the station table"""
+    stations_df = index_stations(stations_df)
+    for id_column, columns in STATION_FILL_COLUMNS.items():
+        fill_from_stations(trips_df, stations_df, id_column, columns)
+    return trips_df, stations_df
@@ -0,0 +1,125 @@
+"""An S3 style bucket served over HTTP, for testing listings and downloads
+
+Objects are listed with paged ListObjectsV2 XML and served with Range, If-Match
+and If-Range support. Every request is recorded with the status it got.
+"""
+import hashlib
+from dataclasses import dataclass
+from dataclasses import field
+from typing import Dict
+from typing import List
+from typing import Optional
+from typing import Tuple
+from xml.sax.saxutils import escape
+
+from aiohttp import web
+
+
+@dataclass
+class Request:
+    method: str
+    key: str
+    headers: Dict[str, str]
+    query: Dict[str, str]
+    status: int = 0
+
+
+@dataclass
+class FakeBucket:
+    objects: Dict[str, bytes] = field(default_factory=dict)
+    page_size: int = 1000  # keys per ListObjectsV2 page
+    ranges: bool = True  # whether Range requests are honoured
+    requests: List[Request] = field(default_factory=list)
+
+    def etag(self, key: str) -> str:
+        return f'"{hashlib.md5(self.objects[key]).hexdigest()}"'
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_get("/bucket/", self.list_objects)
+        app.router.add_get("/bucket/{key:.+}", self.get_object)
+        return app
+
+    def record(self, request: web.Request, key: str) -> Request:
+        recorded = Request(
+            method=request.method,
+            key=key,
+            headers=dict(request.headers),
+            query=dict(request.query),
+        )
+        self.requests.append(recorded)
+        return recorded
+
+    def requests_for(self, key: str) -> List[Request]:
+        return [request for request in self.requests if request.key == key]
+
+    async def list_objects(self, request: web.Request) -> web.Response:
+        recorded = self.record(request, "")
+        if request.query.get("list-type") != "2":
+            recorded.status = 400
+            return web.Response(status=400)
+
+        keys = sorted(self.objects)
+        start = int(request.query.get("continuation-token", "0"))
+        page = keys[start : start + self.page_size]
+        truncated = start + self.page_size < len(keys)
+        contents = "".join(
+            f"<Contents><Key>{escape(key)}</Key></Contents>" for key in page
+        )
+        token = (
+            f"<NextContinuationToken>{start + self.page_size}</NextContinuationToken>"
+            if truncated
+            else ""
+        )
+        recorded.status = 200
+        return web.Response(
+            text=(
+                '<?xml version="1.0" encoding="UTF-8"?>'
+                '<ListBucketResult xmlns="http://s3.amazonaws.com/doc/2006-03-01/">'
+                f"<Name>bucket</Name><KeyCount>{len(page)}</KeyCount>"
+                f"<IsTruncated>{str(truncated).lower()}</IsTruncated>"
+                f"{contents}{token}</ListBucketResult>"
+            ),
+            content_type="application/xml",
+        )
+
+    async def get_object(self, request: web.Request) -> web.Response:
+        key = request.match_info["key"]
+        recorded = self.record(request, key)
+        if key not in self.objects:
+            recorded.status = 404
+            return web.Response(status=404)
+
+        data = self.objects[key]
+        etag = self.etag(key)
+        if request.headers.get("If-Match", etag) != etag:
+            recorded.status = 412
+            return web.Response(status=412)
+
+        byte_range = parse_range(request.headers.get("Range"), len(data))
+        if_range = request.headers.get("If-Range", etag)
+        if byte_range and self.ranges and if_range == etag:
+            start, end = byte_range
+            recorded.status = 206
+            return web.Response(
+                status=206,
+                body=data[start:end],
+                headers={
+                    "ETag": etag,
+                    "Content-Range": f"bytes {start}-{end - 1}/{len(data)}",
+                },
+            )
+
+        recorded.status = 200
+        return web.Response(body=data, headers={"ETag": etag})
+
+
+def parse_range(value: Optional[str], size: int) -> Optional[Tuple[int, int]]:
+    """The [start, end) bytes of a single "bytes=" range, suffixes included"""
+    if not value or not value.startswith("bytes="):
+        return None
+
+    first, _, last = value[len("bytes=") :].partition("-")
+    if not first:
+        return max(size - int(last), 0), size
+    return int(first), min(int(last) + 1, size) if last else size
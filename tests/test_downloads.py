@@ -0,0 +1,62 @@
+import asyncio
+import os
+import random
+from pathlib import Path
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestServer
+
+from opendata.sources.bikeshare.downloads import CachedFileInfo
+from opendata.sources.bikeshare.downloads import download_url
+from opendata.sources.bikeshare.downloads import file_path_for_url
+from opendata.sources.bikeshare.downloads import PartialDownload
+from opendata.sources.bikeshare.downloads import write_partial_meta
+from tests.bucket import FakeBucket
+
+KEY = "2023-tripdata.zip"
+URL_PATH = f"/bucket/{KEY}"
+
+
+def download_after_partial(
+    bucket: FakeBucket, tmp_path: Path, partial: bytes, etag: str
+) -> CachedFileInfo:
+    """Download the archive over an interrupted download of partial"""
+
+    async def run() -> CachedFileInfo:
+        async with TestServer(bucket.app()) as server:
+            url = str(server.make_url(URL_PATH))
+            tmp_local_path = file_path_for_url(url, str(tmp_path)) + ".tmp"
+            with open(tmp_local_path, "wb") as f:
+                f.write(partial)
+            write_partial_meta(
+                tmp_local_path,
+                PartialDownload(
+                    size=len(partial), etag=etag, content_length=len(partial) * 2
+                ),
+            )
+            async with aiohttp.ClientSession() as session:
+                return await download_url(str(tmp_path), session, url)
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("changed", [False, True], ids=["unchanged", "changed"])
+def test_download_url_resumes_with_if_range(changed: bool, tmp_path: Path) -> None:
+    started = random.Random(0).randbytes(100_000)
+    bucket = FakeBucket({KEY: started})
+    etag = bucket.etag(KEY)
+    if changed:
+        bucket.objects[KEY] = random.Random(1).randbytes(100_000)
+
+    cached = download_after_partial(bucket, tmp_path, started[:50_000], etag)
+
+    (request,) = bucket.requests
+    assert request.headers["Range"] == "bytes=50000-"
+    assert request.headers["If-Range"] == etag
+    # A changed archive comes back whole and replaces the partial download
+    assert request.status == (200 if changed else 206)
+    assert cached.downloaded_bytes == (100_000 if changed else 50_000)
+    with open(cached.local_path, "rb") as f:
+        assert f.read() == bucket.objects[KEY]
+    assert not os.path.exists(cached.local_path + ".tmp")
@@ -0,0 +1,110 @@
+import asyncio
+import re
+from pathlib import Path
+from typing import List
+
+import aiohttp
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from opendata.sources.bikeshare.listing import async_extract_hrefs_from_url
+from opendata.sources.bikeshare.listing import async_list_hrefs
+from opendata.sources.bikeshare.listing import listing_base_url
+from tests.bucket import FakeBucket
+
+KEYS = [
+    "202301-tripdata.zip",
+    "202302-tripdata.zip",
+    "202303-tripdata.zip",
+    "Divvy Stations 2023.zip",
+    "index.html",
+]
+
+
+def list_hrefs(app: web.Application, path: str) -> List[str]:
+    async def run() -> List[str]:
+        async with TestServer(app) as server, aiohttp.ClientSession() as session:
+            hrefs = await async_list_hrefs(
+                session, str(server.make_url(path)), timeout_sec=10, headers={}
+            )
+            base_url = str(server.make_url("/"))
+            return [href.replace(base_url, "/") for href in hrefs]
+
+    return asyncio.run(run())
+
+
+def test_listing_base_url() -> None:
+    assert listing_base_url("https://b.s3.amazonaws.com/index.html") == (
+        "https://b.s3.amazonaws.com/"
+    )
+    assert listing_base_url("https://b.s3.amazonaws.com/") == (
+        "https://b.s3.amazonaws.com/"
+    )
+    assert listing_base_url("https://b.s3.amazonaws.com") == (
+        "https://b.s3.amazonaws.com/"
+    )
+    assert listing_base_url("https://example.com/system-data") is None
+
+
+def test_list_hrefs_walks_every_page() -> None:
+    bucket = FakeBucket({key: b"" for key in KEYS}, page_size=2)
+    hrefs = list_hrefs(bucket.app(), "/bucket/index.html")
+
+    assert hrefs == [
+        "/bucket/202301-tripdata.zip",
+        "/bucket/202302-tripdata.zip",
+        "/bucket/202303-tripdata.zip",
+        "/bucket/Divvy%20Stations%202023.zip",
+        "/bucket/index.html",
+    ]
+    pages = [request.query for request in bucket.requests]
+    assert [page.get("continuation-token") for page in pages] == [None, "2", "4"]
+    assert all(page["list-type"] == "2" for page in pages)
+
+
+def html_site() -> web.Application:
+    """Static pages whose directory isn't an S3 bucket"""
+
+    async def index(request: web.Request) -> web.Response:
+        return web.Response(
+            text='<a href="trips-2023.zip">2023</a> <a href="/other/page">More</a>',
+            content_type="text/html",
+        )
+
+    async def forbidden(request: web.Request) -> web.Response:
+        return web.Response(status=403)
+
+    app = web.Application()
+    app.router.add_get("/site/", forbidden)
+    app.router.add_get("/site/index.html", index)
+    app.router.add_get("/site/data.html", index)
+    return app
+
+
+def test_list_hrefs_falls_back_to_html() -> None:
+    expected = ["/site/trips-2023.zip", "/other/page"]
+    assert list_hrefs(html_site(), "/site/index.html") == expected
+    assert list_hrefs(html_site(), "/site/data.html") == expected
+
+
+def test_extract_hrefs_caches_the_listing(tmp_path: Path) -> None:
+    bucket = FakeBucket({key: b"" for key in KEYS}, page_size=2)
+
+    async def run() -> List[List[str]]:
+        async with TestServer(bucket.app()) as server:
+            url = str(server.make_url("/bucket/index.html"))
+            return [
+                await async_extract_hrefs_from_url(
+                    url,
+                    re.compile(r".*tripdata\.zip$"),
+                    timeout_sec=10,
+                    headers={},
+                    cache_dir=str(tmp_path),
+                )
+                for _ in range(2)
+            ]
+
+    first, second = asyncio.run(run())
+    assert len(first) == 3
+    assert second == first
+    assert len(bucket.requests) == 3
@@ -0,0 +1,222 @@
+import asyncio
+import io
+import os
+import random
+import struct
+import zipfile
+from pathlib import Path
+from typing import Callable
+from typing import Dict
+from typing import List
+from typing import Tuple
+
+import aiohttp
+import pytest
+from aiohttp.test_utils import TestServer
+from aiohttp.test_utils import unused_port
+
+from opendata.sources.bikeshare.downloads import CachedFileInfo
+from opendata.sources.bikeshare.downloads import file_path_for_url
+from opendata.sources.bikeshare.downloads import RetryableDownloadError
+from opendata.sources.bikeshare.remote_zip import central_directory_range
+from opendata.sources.bikeshare.remote_zip import coalesce_ranges
+from opendata.sources.bikeshare.remote_zip import download_zip_members
+from opendata.sources.bikeshare.remote_zip import sparse_meta_path
+from opendata.sources.bikeshare.remote_zip import TAIL_BYTES
+from tests.bucket import FakeBucket
+
+KEY = "2023-tripdata.zip"
+TRIPS = ["202301-tripdata.csv", "202302-tripdata.csv", "202303-tripdata.csv"]
+
+
+def trip_member(name: str) -> bool:
+    return name in TRIPS
+
+
+def archive_members(padding: int) -> Dict[str, bytes]:
+    """Trips around a junk member, then padding to grow the central directory"""
+    rng = random.Random(0)
+    members = {
+        name: rng.randbytes(40_000)
+        for name in [TRIPS[0], TRIPS[1], "__MACOSX/._junk", TRIPS[2]]
+    }
+    for i in range(padding):
+        members[f"__MACOSX/._padding-to-grow-the-central-directory-{i:04d}"] = b"x"
+    return members
+
+
+def zip_bytes(members: Dict[str, bytes], zip64: bool = False) -> bytes:
+    """A zip of members stored uncompressed, with zip64 end records if zip64"""
+    # Only archives over 4 GiB need zip64 records, so lower the limit to write
+    # them and point the classic record at them, as writers of such archives do
+    limit = zipfile.ZIP64_LIMIT
+    zipfile.ZIP64_LIMIT = 0 if zip64 else limit
+    try:
+        buffer = io.BytesIO()
+        with zipfile.ZipFile(buffer, "w", zipfile.ZIP_STORED) as zip:
+            for name, data in members.items():
+                zip.writestr(name, data)
+    finally:
+        zipfile.ZIP64_LIMIT = limit
+
+    data = bytearray(buffer.getvalue())
+    if zip64:
+        eocd = data.rfind(b"PK\x05\x06")
+        data[eocd + 12 : eocd + 20] = struct.pack("<LL", 0xFFFFFFFF, 0xFFFFFFFF)
+    return bytes(data)
+
+
+def member_offsets(data: bytes) -> Tuple[Dict[str, int], int]:
+    with zipfile.ZipFile(io.BytesIO(data)) as zip:
+        offsets = {info.filename: info.header_offset for info in zip.infolist()}
+        return offsets, zip.start_dir
+
+
+@pytest.fixture
+def port() -> int:
+    """A port kept across a test's servers, so the archive keeps its URL"""
+    return unused_port()
+
+
+def download(
+    bucket: FakeBucket,
+    tmp_path: Path,
+    port: int,
+    want_member: Callable[[str], bool] = trip_member,
+) -> CachedFileInfo:
+    async def run() -> CachedFileInfo:
+        server = TestServer(bucket.app(), port=port)
+        async with server, aiohttp.ClientSession() as session:
+            return await download_zip_members(
+                str(tmp_path),
+                session,
+                str(server.make_url(f"/bucket/{KEY}")),
+                want_member=want_member,
+            )
+
+    return asyncio.run(run())
+
+
+def fetched_ranges(bucket: FakeBucket) -> List[Tuple[str, str]]:
+    return [
+        (request.headers.get("Range", ""), request.headers.get("If-Match", ""))
+        for request in bucket.requests_for(KEY)
+    ]
+
+
+def test_coalesce_ranges() -> None:
+    assert coalesce_ranges([(30, 40), (0, 10), (10, 20), (40, 45)]) == [
+        (0, 20),
+        (30, 45),
+    ]
+    assert coalesce_ranges([]) == []
+
+
+@pytest.mark.parametrize("zip64", [False, True])
+def test_central_directory_range(zip64: bool) -> None:
+    data = zip_bytes(archive_members(padding=10), zip64=zip64)
+    _, cd_offset = member_offsets(data)
+    eocd = data.rfind(b"PK\x05\x06")
+    cd_end = data.rfind(b"PK\x06\x06") if zip64 else eocd
+
+    tail_offset = max(len(data) - TAIL_BYTES, 0)
+    assert central_directory_range(data[tail_offset:], tail_offset) == (
+        cd_offset,
+        cd_end - cd_offset,
+    )
+
+
+@pytest.mark.parametrize(
+    "padding, zip64",
+    [(0, False), (1000, False), (1000, True)],
+    ids=["directory-in-tail", "large-directory", "zip64"],
+)
+def test_download_zip_members(
+    padding: int, zip64: bool, tmp_path: Path, port: int
+) -> None:
+    members = archive_members(padding)
+    data = zip_bytes(members, zip64=zip64)
+    bucket = FakeBucket({KEY: data})
+    offsets, cd_offset = member_offsets(data)
+
+    cached = download(bucket, tmp_path, port)
+
+    etag = bucket.etag(KEY)
+    tail_offset = len(data) - TAIL_BYTES
+    # Padding pushes the start of the central directory out of the tail
+    assert (cd_offset < tail_offset) == bool(padding)
+    ranges = [(cd_offset, tail_offset)] if padding else []
+    # The first two trips are neighbours, the third follows the junk member
+    trips_end = offsets.get("__MACOSX/._padding-to-grow-the-central-directory-0000")
+    ranges += [
+        (offsets[TRIPS[0]], offsets["__MACOSX/._junk"]),
+        (offsets[TRIPS[2]], trips_end or cd_offset),
+    ]
+    assert fetched_ranges(bucket) == [(f"bytes=-{TAIL_BYTES}", "")] + [
+        (f"bytes={start}-{end - 1}", etag) for start, end in ranges
+    ]
+    assert all(request.status == 206 for request in bucket.requests)
+    assert cached.downloaded_bytes == TAIL_BYTES + sum(
+        end - start for start, end in ranges
+    )
+
+    assert cached.members == TRIPS
+    with zipfile.ZipFile(cached.local_path) as zip:
+        for name in TRIPS:
+            assert zip.read(name) == members[name]
+
+    # Members already fetched aren't fetched again
+    bucket.requests.clear()
+    cached = download(bucket, tmp_path, port)
+    assert bucket.requests == []
+    assert cached.downloaded_bytes == 0
+
+
+def test_download_zip_members_adds_missing_members(tmp_path: Path, port: int) -> None:
+    members = archive_members(padding=0)
+    bucket = FakeBucket({KEY: zip_bytes(members)})
+    offsets, _ = member_offsets(bucket.objects[KEY])
+
+    download(bucket, tmp_path, port, want_member=lambda name: name == TRIPS[0])
+    bucket.requests.clear()
+    cached = download(bucket, tmp_path, port)
+
+    assert [range for range, _ in fetched_ranges(bucket)] == [
+        f"bytes={offsets[TRIPS[1]]}-{offsets['__MACOSX/._junk'] - 1}",
+        f"bytes={offsets[TRIPS[2]]}-{member_offsets(bucket.objects[KEY])[1] - 1}",
+    ]
+    with zipfile.ZipFile(cached.local_path) as zip:
+        for name in TRIPS:
+            assert zip.read(name) == members[name]
+
+
+def test_download_zip_members_discards_a_changed_archive(
+    tmp_path: Path, port: int
+) -> None:
+    bucket = FakeBucket({KEY: zip_bytes(archive_members(padding=0))})
+    cached = download(bucket, tmp_path, port, want_member=lambda name: False)
+    old_etag = bucket.etag(KEY)
+
+    bucket.objects[KEY] = zip_bytes(archive_members(padding=1))
+    bucket.requests.clear()
+    with pytest.raises(RetryableDownloadError):
+        download(bucket, tmp_path, port)
+
+    assert [(r.headers.get("If-Match"), r.status) for r in bucket.requests] == [
+        (old_etag, 412)
+    ]
+    assert not os.path.exists(cached.local_path)
+    assert not os.path.exists(sparse_meta_path(cached.local_path))
+
+
+def test_download_zip_members_without_range_support(tmp_path: Path, port: int) -> None:
+    members = archive_members(padding=0)
+    bucket = FakeBucket({KEY: zip_bytes(members)}, ranges=False)
+
+    cached = download(bucket, tmp_path, port)
+
+    assert [request.status for request in bucket.requests] == [200, 200]
+    assert cached.members is None
+    assert cached.local_path == file_path_for_url(cached.remote_path, str(tmp_path))
+    with open(cached.local_path, "rb") as f:
+        assert f.read() == bucket.objects[KEY]